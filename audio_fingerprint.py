@@ -0,0 +1,126 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Iterable, Hashable
+
+import numpy
+
+# Audio is fingerprinted as mono 16-bit PCM at a low sample rate, which keeps the frequencies that identify a sound
+SAMPLE_RATE = 8000
+SAMPLE_BYTES = 2
+WINDOW_SIZE = 1024
+HOP_SIZE = 512
+# Peaks are picked as the loudest bin of each of these frequency bands, so that each band is represented
+PEAK_BANDS = [(1, 10), (10, 20), (20, 40), (40, 80), (80, 160), (160, 512)]
+# A peak must be this many decibels above its frame's median to count, so that silence has no peaks
+PEAK_MIN_DB = 10
+# Each peak is paired with this many of the peaks which follow it, up to TARGET_MAX_FRAMES frames later
+FAN_OUT = 5
+TARGET_MAX_FRAMES = 63
+FREQ_BITS = 9
+TIME_DELTA_BITS = 6
+# A fingerprint is a hash of a pair of peaks, and the frame offset of the first peak within the audio
+AudioFingerprint = Tuple[int, int]
+
+
+@dataclass
+class AudioMatch:
+    # Number of fingerprints which line up at the best offset between the two recordings
+    matched_fingerprints: int
+    # Seconds into the stored audio that the new audio starts
+    offset: float
+    # Fraction of the new audio's fingerprints which line up
+    score: float
+
+
+def frames_to_seconds(frames: int) -> float:
+    return frames * HOP_SIZE / SAMPLE_RATE
+
+
+def spectrogram(samples: numpy.ndarray) -> numpy.ndarray:
+    """
+    Log magnitude spectrogram of mono audio samples
+    :return: A (num_frames, WINDOW_SIZE // 2 + 1) array of decibels
+    """
+    if len(samples) < WINDOW_SIZE:
+        return numpy.zeros((0, WINDOW_SIZE // 2 + 1))
+    num_frames = 1 + (len(samples) - WINDOW_SIZE) // HOP_SIZE
+    frame_starts = numpy.arange(num_frames)[:, None] * HOP_SIZE
+    frames = samples[frame_starts + numpy.arange(WINDOW_SIZE)[None, :]] * numpy.hanning(WINDOW_SIZE)
+    magnitudes = numpy.abs(numpy.fft.rfft(frames, axis=1))
+    return 20 * numpy.log10(magnitudes + 1e-6)
+
+
+def spectral_peaks(decibels: numpy.ndarray) -> List[Tuple[int, int]]:
+    """
+    Picks the loudest bin in each frequency band of each frame, where it stands out above the rest of that frame
+    :return: A list of (frame, frequency bin) peaks, in time order
+    """
+    if len(decibels) == 0:
+        return []
+    threshold = numpy.median(decibels, axis=1) + PEAK_MIN_DB
+    peaks = []
+    for band_start, band_end in PEAK_BANDS:
+        band = decibels[:, band_start:band_end]
+        loudest = band.argmax(axis=1)
+        loud_enough = band[numpy.arange(len(band)), loudest] > threshold
+        for frame in numpy.nonzero(loud_enough)[0].tolist():
+            peaks.append((frame, band_start + int(loudest[frame])))
+    peaks.sort()
+    return peaks
+
+
+def fingerprint_peaks(peaks: List[Tuple[int, int]]) -> List[AudioFingerprint]:
+    """
+    Hashes each peak together with the frequency and time gap of the next few peaks. Pairs of peaks survive
+    re-encoding and changes of volume far better than the spectrum as a whole.
+    """
+    fingerprints = []
+    for index, (anchor_frame, anchor_bin) in enumerate(peaks):
+        num_targets = 0
+        for target_frame, target_bin in peaks[index + 1:]:
+            time_delta = target_frame - anchor_frame
+            if time_delta == 0:
+                continue
+            if time_delta > TARGET_MAX_FRAMES or num_targets == FAN_OUT:
+                break
+            fingerprint_hash = (
+                (anchor_bin << (FREQ_BITS + TIME_DELTA_BITS)) | (target_bin << TIME_DELTA_BITS) | time_delta
+            )
+            fingerprints.append((fingerprint_hash, anchor_frame))
+            num_targets += 1
+    return fingerprints
+
+
+def fingerprint_pcm(pcm: bytes) -> List[AudioFingerprint]:
+    """
+    Fingerprints raw mono 16-bit little endian PCM audio, sampled at SAMPLE_RATE
+    """
+    samples = numpy.frombuffer(pcm[:len(pcm) - len(pcm) % SAMPLE_BYTES], dtype="<i2").astype(numpy.float32)
+    return fingerprint_peaks(spectral_peaks(spectrogram(samples)))
+
+
+def match_fingerprints(
+        fingerprints: List[AudioFingerprint],
+        stored_fingerprints: Dict[Hashable, Iterable[AudioFingerprint]]
+) -> Dict[Hashable, AudioMatch]:
+    """
+    Scores each stored recording by how many fingerprints line up with the given fingerprints at a single offset
+    :param fingerprints: The new recording's fingerprints
+    :param stored_fingerprints: Stored fingerprints sharing hashes with the new recording, by recording
+    :return: The best match with each stored recording
+    """
+    offsets_by_hash: Dict[int, List[int]] = {}
+    for fingerprint_hash, offset in fingerprints:
+        offsets_by_hash.setdefault(fingerprint_hash, []).append(offset)
+    matches = {}
+    for key, stored in stored_fingerprints.items():
+        offset_votes = Counter(
+            stored_offset - offset
+            for fingerprint_hash, stored_offset in stored
+            for offset in offsets_by_hash.get(fingerprint_hash, [])
+        )
+        if not offset_votes:
+            continue
+        best_offset, votes = offset_votes.most_common(1)[0]
+        matches[key] = AudioMatch(votes, frames_to_seconds(best_offset), votes / len(fingerprints))
+    return matches
@@ -0,0 +1,51 @@
+"""
+Compares the speed of hashing frames one PIL image at a time with imagehash, against the batched numpy hashing in
+frame_hash, and checks they produce the same hashes.
+Run from the repository root with: python -m benchmarks.dhash_benchmark
+"""
+import argparse
+import time
+
+import imagehash
+import numpy
+from PIL import Image
+
+from frame_hash import batch_dhash, dhash_from_pixels, hash_to_str, FRAME_WIDTH, FRAME_HEIGHT
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def hash_with_imagehash(frames: numpy.ndarray):
+    return [str(imagehash.dhash(Image.fromarray(frame, mode="L"))) for frame in frames]
+
+
+def hash_with_python(frames: numpy.ndarray):
+    return [hash_to_str(dhash_from_pixels(frame.tobytes())) for frame in frames]
+
+
+def hash_with_numpy(frames: numpy.ndarray):
+    return [hash_to_str(int(image_hash)) for image_hash in batch_dhash(frames)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=100_000, help="Number of random frames to hash")
+    args = parser.parse_args()
+    frames = numpy.random.default_rng(0).integers(0, 256, (args.frames, FRAME_HEIGHT, FRAME_WIDTH), dtype=numpy.uint8)
+    reference, reference_time = time_call(hash_with_imagehash, frames)
+    print(f"imagehash.dhash per image: {reference_time:.3f}s ({args.frames / reference_time:,.0f} frames/s)")
+    for name, func in [("python per frame", hash_with_python), ("numpy batch", hash_with_numpy)]:
+        hashes, elapsed = time_call(func, frames)
+        identical = "identical" if hashes == reference else "MISMATCHED"
+        print(
+            f"{name}: {elapsed:.3f}s ({args.frames / elapsed:,.0f} frames/s), "
+            f"{reference_time / elapsed:.1f}x speedup, hashes {identical}"
+        )
+
+
+if __name__ == "__main__":
+    main()
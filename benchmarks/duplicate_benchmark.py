@@ -0,0 +1,207 @@
+"""
+Measures duplicate detection end to end, on synthetic videos generated locally with ffmpeg's lavfi sources.
+Each source video is hashed into a fresh database, along with a copy of it in a reference channel, which is sampled
+only at keyframes. Then altered copies of them (re-encoded, cropped, sped up, and clipped), and unrelated videos, are
+hashed and looked up against both. Reports hashing throughput, database lookup
+latency, and the precision and recall of the matches found.
+Needs ffmpeg and ffprobe on the path, but no network access.
+Run from the repository root with: python -m benchmarks.duplicate_benchmark
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import List, Dict, Optional
+
+from database import Database
+from group import ChannelData, WorkshopData
+from helpers.duplicate_helper import DuplicateHelper
+from message import MessageData
+from tasks.task_worker import TaskWorker
+
+# Altered copies made of each source video, as ffmpeg options
+VARIANTS = {
+    "reencode": lambda duration: "-vf scale=240:-2 -b:v 150k",
+    "crop": lambda duration: "-vf crop=iw*0.9:ih*0.9,scale=320:240",
+    "speed": lambda duration: "-vf setpts=PTS/1.25",
+    "clip": lambda duration: f"-ss {duration / 4} -t {duration / 2}",
+}
+SOURCE_CHAT = ChannelData(-1001, "benchmark_sources", "Benchmark sources")
+QUERY_CHAT = WorkshopData(-1002, None, "Benchmark queries")
+REFERENCE_CHAT = ChannelData(-1003, "benchmark_references", "Benchmark references")
+# Keyframe interval of reference videos, in frames, a keyframe every 2 seconds
+REFERENCE_KEYFRAME_INTERVAL = 50
+
+
+@dataclass
+class BenchmarkVideo:
+    message_data: MessageData
+    variant: str
+    # The source video this was made from, if any
+    source: Optional[MessageData] = None
+
+
+def run_ffmpeg(*args: str) -> None:
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True)
+
+
+def generate_source(path: str, seed: int, duration: float) -> None:
+    # Shifting gradients alone look alike at hash resolution, so a box wanders over them, along a path set by the seed
+    rng = random.Random(seed)
+    box_x = f"(iw-80)*(0.5+0.5*sin(t*{rng.uniform(0.3, 2):.2f}+{rng.uniform(0, 6.28):.2f}))"
+    box_y = f"(ih-60)*(0.5+0.5*sin(t*{rng.uniform(0.3, 2):.2f}+{rng.uniform(0, 6.28):.2f}))"
+    run_ffmpeg(
+        "-f", "lavfi", "-i",
+        f"gradients=s=320x240:r=25:seed={seed}:speed=0.02:nb_colors=4,"
+        f"drawbox=x='{box_x}':y='{box_y}':w=80:h=60:c=black:t=fill",
+        "-t", str(duration), "-pix_fmt", "yuv420p", path
+    )
+
+
+def generate_variant(source_path: str, path: str, options: str) -> None:
+    run_ffmpeg("-i", source_path, *options.split(), "-pix_fmt", "yuv420p", path)
+
+
+def generate_reference(source_path: str, path: str) -> None:
+    # Re-encoded, so that it is not byte-identical to the source, and does not share its hashes
+    run_ffmpeg("-i", source_path, "-g", str(REFERENCE_KEYFRAME_INTERVAL), "-pix_fmt", "yuv420p", path)
+
+
+def make_message(chat_data, message_id: int, path: str) -> MessageData:
+    return MessageData(
+        chat_data.chat_id, message_id, datetime.datetime.now(datetime.timezone.utc), None, False, True, path,
+        "video/mp4", None, None, False
+    )
+
+
+def generate_videos(work_dir: str, num_sources: int, duration: float) -> Dict[str, List[BenchmarkVideo]]:
+    sources = []
+    references = []
+    queries = []
+    for index in range(num_sources):
+        source_path = os.path.join(work_dir, f"source_{index}.mp4")
+        generate_source(source_path, index, duration)
+        source = make_message(SOURCE_CHAT, index + 1, source_path)
+        sources.append(BenchmarkVideo(source, "source"))
+        reference_path = os.path.join(work_dir, f"reference_{index}.mp4")
+        generate_reference(source_path, reference_path)
+        references.append(BenchmarkVideo(make_message(REFERENCE_CHAT, index + 1, reference_path), "reference", source))
+        for variant, options in VARIANTS.items():
+            variant_path = os.path.join(work_dir, f"{variant}_{index}.mp4")
+            generate_variant(source_path, variant_path, options(duration))
+            queries.append(BenchmarkVideo(make_message(QUERY_CHAT, len(queries) + 1, variant_path), variant, source))
+        # An unrelated video, which should match nothing
+        unrelated_path = os.path.join(work_dir, f"unrelated_{index}.mp4")
+        generate_source(unrelated_path, 1000 + index, duration)
+        queries.append(BenchmarkVideo(make_message(QUERY_CHAT, len(queries) + 1, unrelated_path), "unrelated"))
+    return {"sources": sources, "references": references, "queries": queries}
+
+
+async def hash_videos(helper: DuplicateHelper, videos: List[BenchmarkVideo]) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(helper.create_message_hashes(video.message_data) for video in videos))
+    return time.perf_counter() - start
+
+
+async def lookup(helper: DuplicateHelper, video: BenchmarkVideo, chat_id: int, max_distance: int) -> List[MessageData]:
+    image_hashes = set(helper.database.get_hashes_for_message(video.message_data))
+    matches = await helper.find_duplicate_messages(video.message_data, image_hashes, max_distance, {video.message_data})
+    return [message_data for message_data in matches if message_data.chat_id == chat_id]
+
+
+async def report_matches(
+        helper: DuplicateHelper,
+        queries: List[BenchmarkVideo],
+        chat_id: int,
+        expected_matches: Dict[MessageData, MessageData],
+        max_distance: int
+) -> None:
+    """
+    Looks each query up against the videos in one chat, and prints lookup latency, precision, and recall
+    :param expected_matches: The video in the chat which each source video should match
+    """
+    lookup_times = []
+    true_positives = {variant: 0 for variant in VARIANTS}
+    false_negatives = {variant: 0 for variant in VARIANTS}
+    false_positives = 0
+    for video in queries:
+        expected = expected_matches.get(video.source)
+        start = time.perf_counter()
+        matches = await lookup(helper, video, chat_id, max_distance)
+        lookup_times.append(time.perf_counter() - start)
+        for match in matches:
+            if match != expected:
+                false_positives += 1
+        if expected is not None:
+            if expected in matches:
+                true_positives[video.variant] += 1
+            else:
+                false_negatives[video.variant] += 1
+    print(
+        f"Lookup latency: median {statistics.median(lookup_times) * 1000:.2f} ms, "
+        f"max {max(lookup_times) * 1000:.2f} ms, over {len(lookup_times)} lookups"
+    )
+    total_true_positives = sum(true_positives.values())
+    precision = total_true_positives / max(total_true_positives + false_positives, 1)
+    recall = total_true_positives / max(total_true_positives + sum(false_negatives.values()), 1)
+    print(f"Precision: {precision:.3f}, recall: {recall:.3f}, at a hash distance of {max_distance}")
+    for variant in VARIANTS:
+        found = true_positives[variant]
+        print(f"  {variant}: found {found}/{found + false_negatives[variant]}")
+
+
+async def run_benchmark(work_dir: str, num_sources: int, duration: float, max_distance: int) -> None:
+    generate_start = time.perf_counter()
+    videos = generate_videos(work_dir, num_sources, duration)
+    print(f"Generated {num_sources * (len(VARIANTS) + 3)} videos in {time.perf_counter() - generate_start:.1f}s")
+
+    class BenchmarkDatabase(Database):
+        DB_FILE = os.path.join(work_dir, "benchmark.sqlite")
+
+    database = BenchmarkDatabase()
+    for chat_data in [SOURCE_CHAT, QUERY_CHAT, REFERENCE_CHAT]:
+        database.save_chat(chat_data)
+    all_videos = videos["sources"] + videos["references"] + videos["queries"]
+    database.save_messages(video.message_data for video in all_videos)
+    helper = DuplicateHelper(database, None, TaskWorker(), [])
+    # Reference channels are read only channels in the config, which are sampled at keyframes only
+    helper.reference_chat_ids = {REFERENCE_CHAT.chat_id}
+
+    hash_time = await hash_videos(helper, all_videos)
+    num_frames = sum(len(database.get_frame_sequence(video.message_data) or []) for video in all_videos)
+    print(
+        f"Hashed {len(all_videos)} videos, {num_frames} frames, in {hash_time:.2f}s: "
+        f"{num_frames / hash_time:,.0f} frames/s, {hash_time / len(all_videos) * 1000:.0f} ms per video"
+    )
+
+    print("Against sources:")
+    source_matches = {video.message_data: video.message_data for video in videos["sources"]}
+    await report_matches(helper, videos["queries"], SOURCE_CHAT.chat_id, source_matches, max_distance)
+    print("Against keyframe sampled references:")
+    reference_matches = {video.source: video.message_data for video in videos["references"]}
+    await report_matches(helper, videos["queries"], REFERENCE_CHAT.chat_id, reference_matches, max_distance)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sources", type=int, default=8, help="Number of source videos to generate")
+    parser.add_argument("--duration", type=float, default=20, help="Length of each source video, in seconds")
+    parser.add_argument("--distance", type=int, default=4, help="Maximum hamming distance for frame hashes to match")
+    parser.add_argument("--work-dir", help="Directory to generate videos in, rather than a temporary one")
+    args = parser.parse_args()
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        asyncio.run(run_benchmark(args.work_dir, args.sources, args.duration, args.distance))
+        return
+    with tempfile.TemporaryDirectory() as work_dir:
+        asyncio.run(run_benchmark(work_dir, args.sources, args.duration, args.distance))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
+import datetime
+import glob
+import logging
+import os
 import sqlite3
 from collections import defaultdict
-from typing import List, Optional, Type, TypeVar, Set, Iterable
-
-import dateutil.parser
+from contextlib import contextmanager
+from typing import List, Optional, Type, TypeVar, Set, Iterable, Iterator, Tuple, Dict, Collection
 
+from audio_fingerprint import AudioFingerprint
 from group import ChatData, WorkshopData, ChannelData
-from message import MessageData
+from message import MessageData, MediaLocator
+from sequence_match import FrameSequence
 
 chat_types = {
     "channel": ChannelData,
@@ -16,35 +21,135 @@ T = TypeVar("T", bound=ChatData)
 
 
 def message_data_from_row(row: sqlite3.Row) -> MessageData:
+    # Unpack by position, rather than by name, as this is called for every row of large chats
+    (
+        chat_id, message_id, timestamp, text, is_forward,
+        file_path, file_mime_type, reply_to, sender_id, is_scheduled
+    ) = row
     return MessageData(
-        row["chat_id"],
-        row["message_id"],
-        dateutil.parser.parse(row["datetime"]),
-        row["text"],
-        bool(row["is_forward"]),
-        row["file_path"] is not None,
-        row["file_path"],
-        row["file_mime_type"],
-        row["reply_to"],
-        row["sender_id"],
-        bool(row["is_scheduled"])
+        chat_id,
+        message_id,
+        datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+        text,
+        bool(is_forward),
+        file_path is not None,
+        file_path,
+        file_mime_type,
+        reply_to,
+        sender_id,
+        bool(is_scheduled)
+    )
+
+
+def hash_to_db(image_hash: int) -> int:
+    """Converts an unsigned 64-bit frame hash to the signed integer SQLite stores"""
+    return image_hash - (1 << 64) if image_hash >= (1 << 63) else image_hash
+
+
+def hash_from_db(db_hash: int) -> int:
+    """Converts a signed integer from SQLite back to an unsigned 64-bit frame hash"""
+    return db_hash & ((1 << 64) - 1)
+
+
+def hex_hash_to_db(hash_str: str) -> int:
+    """Converts a hex string frame hash, as older databases stored them, to the signed integer SQLite stores"""
+    return hash_to_db(int(hash_str, 16))
+
+
+def media_locator_from_row(row: sqlite3.Row) -> Optional[MediaLocator]:
+    if row["document_id"] is None:
+        return None
+    return MediaLocator(
+        row["document_id"],
+        row["access_hash"],
+        row["file_reference"],
+        row["file_size"],
+        row["dc_id"]
+    )
+
+
+def message_data_to_row(message: MessageData) -> Tuple:
+    return (
+        message.chat_id, message.message_id, int(message.datetime.timestamp()), message.text, message.is_forward,
+        message.file_path, message.file_mime_type, message.reply_to, message.sender_id, message.is_scheduled
     )
 
 
 class Database:
     DB_FILE = "pipeline.sqlite"
+    SCHEMA_FILE = "database_schema.sql"
+    MIGRATIONS_DIR = "migrations"
 
     def __init__(self) -> None:
         self.conn = sqlite3.connect(self.DB_FILE)
         self.conn.row_factory = sqlite3.Row
+        self._batch_depth = 0
+        # Used by migrations
+        self.conn.create_function("hex_hash_to_int", 1, hex_hash_to_db)
+        self._configure_connection()
         self._create_db()
+        self._run_migrations()
+
+    def _configure_connection(self) -> None:
+        # Write-ahead logging lets readers carry on during writes, and only needs a full sync at checkpoints
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _commit(self) -> None:
+        # Inside a batch, the commit is deferred until the outermost batch completes
+        if self._batch_depth == 0:
+            self.conn.commit()
+
+    @contextmanager
+    def batch(self) -> Iterator['Database']:
+        """
+        Groups all writes made inside the context into a single transaction, which is committed when the outermost
+        batch exits, or rolled back if it raises.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.rollback()
+            raise
+        self._batch_depth -= 1
+        self._commit()
 
     def _create_db(self) -> None:
         cur = self.conn.cursor()
-        with open("database_schema.sql", "r") as f:
+        with open(self.SCHEMA_FILE, "r") as f:
             cur.executescript(f.read())
         self.conn.commit()
 
+    def _list_migrations(self) -> List[Tuple[int, str]]:
+        # Migration files are named with their version number first, e.g. 0001_description.sql
+        migrations = []
+        for migration_path in glob.glob(f"{self.MIGRATIONS_DIR}/*.sql"):
+            version = int(os.path.basename(migration_path).split("_", 1)[0])
+            migrations.append((version, migration_path))
+        return sorted(migrations)
+
+    def _run_migrations(self) -> None:
+        cur = self.conn.cursor()
+        schema_version = cur.execute("PRAGMA user_version").fetchone()[0]
+        pending = [(version, path) for version, path in self._list_migrations() if version > schema_version]
+        if not pending:
+            return
+        for version, migration_path in pending:
+            logging.info(f"Applying database migration: {migration_path}")
+            with open(migration_path, "r") as f:
+                migration_sql = f.read()
+            try:
+                cur.executescript(f"BEGIN;\n{migration_sql}\nPRAGMA user_version = {version};\nCOMMIT;")
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        # Update the statistics the query planner uses to pick indexes
+        cur.execute("ANALYZE")
+        self.conn.commit()
+
     def save_chat(self, chat_data: ChatData):
         cur = self.conn.cursor()
         chat_type = chat_types_inv[chat_data.__class__]
@@ -53,7 +158,7 @@ class Database:
             "ON CONFLICT(chat_id) DO UPDATE SET username=excluded.username, title=excluded.title;",
             (chat_data.chat_id, chat_data.username, chat_data.title, chat_type)
         )
-        self.conn.commit()
+        self._commit()
         cur.close()
 
     def list_chats(self, chat_type: Type[T]) -> List[T]:
@@ -93,40 +198,102 @@ class Database:
         cur = self.conn.cursor()
         messages = []
         for row in cur.execute(
-                "SELECT chat_id, message_id, datetime, text, is_forward, "
-                "file_path, file_mime_type, reply_to, sender_id, is_scheduled "
-                "FROM messages WHERE chat_id = ?",
+                "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
+                "m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled, "
+                "ml.document_id, ml.access_hash, ml.file_reference, ml.file_size, ml.dc_id "
+                "FROM messages m "
+                "LEFT JOIN media_locators ml ON m.entry_id = ml.entry_id "
+                "WHERE m.chat_id = ?",
                 (chat_data.chat_id,)
         ):
-            messages.append(message_data_from_row(row))
+            message_data = message_data_from_row(row[:10])
+            message_data.media_locator = media_locator_from_row(row)
+            messages.append(message_data)
         return messages
 
     def save_message(self, message: MessageData) -> None:
+        self.save_messages([message])
+
+    def save_messages(self, messages: Iterable[MessageData]) -> None:
+        messages = list(messages)
         cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO messages (chat_id, message_id, datetime, text, is_forward, "
+        cur.executemany(
+            "INSERT INTO messages (chat_id, message_id, timestamp, text, is_forward, "
             "file_path, file_mime_type, reply_to, sender_id, is_scheduled) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
             "ON CONFLICT(chat_id, message_id, is_scheduled) "
-            "DO UPDATE SET datetime=excluded.datetime, text=excluded.text, is_forward=excluded.is_forward, "
+            "DO UPDATE SET timestamp=excluded.timestamp, text=excluded.text, is_forward=excluded.is_forward, "
             "file_path=excluded.file_path, file_mime_type=excluded.file_mime_type, "
             "reply_to=excluded.reply_to, sender_id=excluded.sender_id",
-            (
-                message.chat_id, message.message_id, message.datetime, message.text, message.is_forward,
-                message.file_path, message.file_mime_type, message.reply_to, message.sender_id, message.is_scheduled
-            )
+            [message_data_to_row(message) for message in messages]
+        )
+        self._save_media_locators(cur, messages)
+        self._commit()
+
+    def save_media_locator(self, message: MessageData) -> None:
+        """Stores a message's media locator, such as after its file reference has been refreshed"""
+        self._save_media_locators(self.conn.cursor(), [message])
+        self._commit()
+
+    @staticmethod
+    def _save_media_locators(cur: sqlite3.Cursor, messages: List[MessageData]) -> None:
+        cur.executemany(
+            "INSERT INTO media_locators (entry_id, document_id, access_hash, file_reference, file_size, dc_id) "
+            "SELECT entry_id, ?, ?, ?, ?, ? FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ? "
+            "ON CONFLICT(entry_id) DO UPDATE SET document_id=excluded.document_id, "
+            "access_hash=excluded.access_hash, file_reference=excluded.file_reference, "
+            "file_size=excluded.file_size, dc_id=excluded.dc_id",
+            [
+                (
+                    message.media_locator.document_id, message.media_locator.access_hash,
+                    message.media_locator.file_reference, message.media_locator.file_size,
+                    message.media_locator.dc_id,
+                    message.chat_id, message.message_id, message.is_scheduled
+                )
+                for message in messages if message.media_locator is not None
+            ]
         )
-        self.conn.commit()
 
     def remove_message(self, message: MessageData) -> None:
+        self.remove_messages([message])
+
+    def remove_messages(self, messages: Iterable[MessageData]) -> None:
         cur = self.conn.cursor()
-        cur.execute(
+        message_keys = [(message.chat_id, message.message_id, message.is_scheduled) for message in messages]
+        for table in [
+            "media_locators", "file_digests", "video_frame_sequences",
+            "audio_fingerprints", "audio_fingerprinted_messages"
+        ]:
+            cur.executemany(
+                f"DELETE FROM {table} WHERE entry_id IN ("
+                "  SELECT entry_id FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ?"
+                ")",
+                message_keys
+            )
+        cur.executemany(
             "DELETE FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ?",
-            (message.chat_id, message.message_id, message.is_scheduled)
+            message_keys
         )
-        self.conn.commit()
+        self._commit()
 
-    def get_hashes_for_message(self, message: MessageData) -> List[str]:
+    def get_last_synced_message_id(self, chat_data: ChatData) -> Optional[int]:
+        cur = self.conn.cursor()
+        cur.execute("SELECT last_message_id FROM chat_sync_state WHERE chat_id = ?", (chat_data.chat_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return row["last_message_id"]
+
+    def save_last_synced_message_id(self, chat_data: ChatData, last_message_id: int) -> None:
+        cur = self.conn.cursor()
+        cur.execute(
+            "INSERT INTO chat_sync_state (chat_id, last_message_id) VALUES (?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET last_message_id=excluded.last_message_id",
+            (chat_data.chat_id, last_message_id)
+        )
+        self._commit()
+
+    def get_hashes_for_message(self, message: MessageData) -> List[int]:
         cur = self.conn.cursor()
         hashes = []
         for row in cur.execute(
@@ -136,40 +303,45 @@ class Database:
                 (message.chat_id, message.message_id, message.is_scheduled)
         ):
             if row["hash"] is not None:
-                hashes.append(row["hash"])
+                hashes.append(hash_from_db(row["hash"]))
         return hashes
 
+    def list_distinct_hashes(self) -> Iterator[int]:
+        cur = self.conn.cursor()
+        for row in cur.execute("SELECT DISTINCT hash FROM video_hashes"):
+            yield hash_from_db(row["hash"])
+
     def get_messages_needing_hashing(self) -> List[MessageData]:
         cur = self.conn.cursor()
         messages = []
         for row in cur.execute(
-                "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
+                "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
                 "m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled "
                 "FROM messages m "
-                "LEFT JOIN video_hashes vh ON m.entry_id = vh.entry_id "
-                "WHERE vh.hash IS NULL AND m.file_path IS NOT NULL"
+                "LEFT JOIN video_frame_sequences vfs ON m.entry_id = vfs.entry_id "
+                "WHERE vfs.entry_id IS NULL AND m.file_path IS NOT NULL"
         ):
             messages.append(message_data_from_row(row))
         return messages
 
-    def get_messages_for_hashes(self, image_hashes: Set[str]) -> List[MessageData]:
+    def get_messages_for_hashes(self, image_hashes: Set[int]) -> List[MessageData]:
         cur = self.conn.cursor()
         messages = defaultdict(lambda: {})
         # Chunk this up, as it will otherwise fail if there are too many hashes
         image_hash_lists = chunks(image_hashes, 500)
         for image_hash_list in image_hash_lists:
             for row in cur.execute(
-                    "SELECT DISTINCT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
+                    "SELECT DISTINCT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
                     "m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled "
                     "FROM video_hashes v "
                     "LEFT JOIN messages m on v.entry_id = m.entry_id "
-                    f"WHERE v.hash IN ({','.join('?' * len(image_hash_list))}) AND m.datetime IS NOT NULL",
-                    list(image_hash_list)
+                    f"WHERE v.hash IN ({','.join('?' * len(image_hash_list))}) AND m.timestamp IS NOT NULL",
+                    [hash_to_db(image_hash) for image_hash in image_hash_list]
             ):
                 messages[row["chat_id"]][row["message_id"]] = message_data_from_row(row)
         return [msg for chat_id, chat_msgs in messages.items() for msg_id, msg in chat_msgs.items()]
 
-    def save_hashes(self, message: MessageData, hashes: Set[str]) -> None:
+    def save_hashes(self, message: MessageData, hashes: Set[int]) -> None:
         cur = self.conn.cursor()
         cur.execute(
             "SELECT entry_id FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ?",
@@ -180,12 +352,155 @@ class Database:
             return
         entry_id = result["entry_id"]
         cur = self.conn.cursor()
-        for hash_str in hashes:
-            cur.execute(
-                "INSERT INTO video_hashes (hash, entry_id) VALUES (?, ?) ON CONFLICT(hash, entry_id) DO NOTHING;",
-                (hash_str, entry_id)
+        cur.executemany(
+            "INSERT INTO video_hashes (hash, entry_id) VALUES (?, ?) ON CONFLICT(hash, entry_id) DO NOTHING;",
+            [(hash_to_db(image_hash), entry_id) for image_hash in hashes]
+        )
+        self._commit()
+
+    def save_file_digest(self, message: MessageData, digest: bytes) -> None:
+        cur = self.conn.cursor()
+        cur.execute(
+            "INSERT INTO file_digests (entry_id, digest) "
+            "SELECT entry_id, ? FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ? "
+            "ON CONFLICT(entry_id) DO UPDATE SET digest=excluded.digest",
+            (digest, message.chat_id, message.message_id, message.is_scheduled)
+        )
+        self._commit()
+
+    def get_frame_sequence_for_digest(self, digest: bytes) -> Optional[FrameSequence]:
+        """Gets the frame sequence of whichever stored file, with the given content digest, has been hashed"""
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT vfs.hashes, vfs.frame_times FROM file_digests fd "
+            "JOIN video_frame_sequences vfs ON fd.entry_id = vfs.entry_id "
+            "WHERE fd.digest = ? LIMIT 1",
+            (digest,)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+        return FrameSequence.from_bytes(result["hashes"], result["frame_times"])
+
+    def save_frame_sequence(self, message: MessageData, sequence: FrameSequence) -> None:
+        cur = self.conn.cursor()
+        cur.execute(
+            "INSERT INTO video_frame_sequences (entry_id, hashes, frame_times) "
+            "SELECT entry_id, ?, ? FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ? "
+            "ON CONFLICT(entry_id) DO UPDATE SET hashes=excluded.hashes, frame_times=excluded.frame_times",
+            (
+                sequence.hashes_to_bytes(), sequence.frame_times_to_bytes(),
+                message.chat_id, message.message_id, message.is_scheduled
             )
-        self.conn.commit()
+        )
+        self._commit()
+
+    def get_frame_sequence(self, message: MessageData) -> Optional[FrameSequence]:
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT vfs.hashes, vfs.frame_times FROM messages m "
+            "JOIN video_frame_sequences vfs ON m.entry_id = vfs.entry_id "
+            "WHERE m.chat_id = ? AND m.message_id = ? AND m.is_scheduled = ?",
+            (message.chat_id, message.message_id, message.is_scheduled)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+        return FrameSequence.from_bytes(result["hashes"], result["frame_times"])
+
+    def save_audio_fingerprints(self, message: MessageData, fingerprints: List[AudioFingerprint]) -> None:
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT entry_id FROM messages WHERE chat_id = ? AND message_id = ? AND is_scheduled = ?",
+            (message.chat_id, message.message_id, message.is_scheduled)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return
+        entry_id = result["entry_id"]
+        cur.execute("DELETE FROM audio_fingerprints WHERE entry_id = ?", (entry_id,))
+        cur.executemany(
+            "INSERT INTO audio_fingerprints (hash, entry_id, frame_offset) VALUES (?, ?, ?)",
+            [(fingerprint_hash, entry_id, offset) for fingerprint_hash, offset in fingerprints]
+        )
+        cur.execute(
+            "INSERT INTO audio_fingerprinted_messages (entry_id) VALUES (?) ON CONFLICT(entry_id) DO NOTHING",
+            (entry_id,)
+        )
+        self._commit()
+
+    def _list_audio_fingerprints(self, entry_id: int) -> List[AudioFingerprint]:
+        cur = self.conn.cursor()
+        return [
+            (row["hash"], row["frame_offset"])
+            for row in cur.execute("SELECT hash, frame_offset FROM audio_fingerprints WHERE entry_id = ?", (entry_id,))
+        ]
+
+    def get_audio_fingerprints(self, message: MessageData) -> Optional[List[AudioFingerprint]]:
+        """Lists the audio fingerprints of a message, or None if it has not been fingerprinted"""
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT afm.entry_id FROM messages m "
+            "JOIN audio_fingerprinted_messages afm ON m.entry_id = afm.entry_id "
+            "WHERE m.chat_id = ? AND m.message_id = ? AND m.is_scheduled = ?",
+            (message.chat_id, message.message_id, message.is_scheduled)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+        return self._list_audio_fingerprints(result["entry_id"])
+
+    def get_audio_fingerprints_for_digest(self, digest: bytes) -> Optional[List[AudioFingerprint]]:
+        """Lists the audio fingerprints of whichever stored file with the given content digest has been fingerprinted"""
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT afm.entry_id FROM file_digests fd "
+            "JOIN audio_fingerprinted_messages afm ON fd.entry_id = afm.entry_id "
+            "WHERE fd.digest = ? LIMIT 1",
+            (digest,)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+        return self._list_audio_fingerprints(result["entry_id"])
+
+    def get_audio_fingerprints_for_hashes(
+            self,
+            fingerprint_hashes: Set[int],
+            chat_ids: Collection[int]
+    ) -> Dict[MessageData, List[AudioFingerprint]]:
+        """Lists the stored fingerprints with any of the given hashes, by the message in one of the given chats"""
+        cur = self.conn.cursor()
+        fingerprints = defaultdict(list)
+        chat_ids = list(chat_ids)
+        for hash_list in chunks(fingerprint_hashes, 500):
+            for row in cur.execute(
+                    "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
+                    "m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled, af.hash, af.frame_offset "
+                    "FROM audio_fingerprints af "
+                    "JOIN messages m ON af.entry_id = m.entry_id "
+                    f"WHERE af.hash IN ({','.join('?' * len(hash_list))}) "
+                    f"AND m.chat_id IN ({','.join('?' * len(chat_ids))})",
+                    hash_list + chat_ids
+            ):
+                fingerprints[message_data_from_row(row[:10])].append((row["hash"], row["frame_offset"]))
+        return dict(fingerprints)
+
+    def get_messages_needing_audio_fingerprints(self, chat_ids: Collection[int]) -> List[MessageData]:
+        cur = self.conn.cursor()
+        chat_ids = list(chat_ids)
+        return [
+            message_data_from_row(row)
+            for row in cur.execute(
+                "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
+                "m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled "
+                "FROM messages m "
+                "LEFT JOIN audio_fingerprinted_messages afm ON m.entry_id = afm.entry_id "
+                "WHERE afm.entry_id IS NULL AND m.file_path IS NOT NULL "
+                f"AND m.chat_id IN ({','.join('?' * len(chat_ids))})",
+                chat_ids
+            )
+        ]
 
     def remove_message_hashes(self, message: MessageData) -> None:
         cur = self.conn.cursor()
@@ -199,7 +514,10 @@ class Database:
         entry_id = result["entry_id"]
         cur = self.conn.cursor()
         cur.execute("DELETE FROM video_hashes WHERE entry_id = ?", (entry_id,))
-        self.conn.commit()
+        cur.execute("DELETE FROM video_frame_sequences WHERE entry_id = ?", (entry_id,))
+        cur.execute("DELETE FROM audio_fingerprints WHERE entry_id = ?", (entry_id,))
+        cur.execute("DELETE FROM audio_fingerprinted_messages WHERE entry_id = ?", (entry_id,))
+        self._commit()
 
     def get_message_history(self, message: MessageData) -> List[MessageData]:
         """
@@ -218,12 +536,12 @@ class Database:
                 "  WHERE m.message_id=parent.x AND m.reply_to IS NOT NULL "
                 "    AND m.chat_id = :chat_id AND m.is_scheduled = :scheduled"
                 ") "
-                "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward, "
+                "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward, "
                 "  m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled "
                 "FROM parent p "
                 "LEFT JOIN messages m ON m.message_id = p.x "
                 "WHERE m.chat_id = :chat_id AND m.is_scheduled = :scheduled "
-                "ORDER BY datetime DESC;",
+                "ORDER BY m.timestamp DESC;",
                 {
                     "msg_id": message.message_id,
                     "chat_id": message.chat_id,
@@ -250,12 +568,12 @@ class Database:
                 "  FROM messages m, children "
                 "  WHERE m.reply_to = children.x AND m.chat_id = :chat_id AND m.is_scheduled = :scheduled"
                 ") "
-                "SELECT m.chat_id, m.message_id, m.datetime, m.text, m.is_forward,"
+                "SELECT m.chat_id, m.message_id, m.timestamp, m.text, m.is_forward,"
                 "  m.file_path, m.file_mime_type, m.reply_to, m.sender_id, m.is_scheduled "
                 "FROM children c "
                 "LEFT JOIN messages m ON m.message_id = c.x "
                 "WHERE m.chat_id = :chat_id AND m.is_scheduled = :scheduled "
-                "ORDER BY m.datetime;",
+                "ORDER BY m.timestamp;",
                 {
                     "msg_id": message.message_id,
                     "chat_id": message.chat_id,
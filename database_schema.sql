@@ -47,3 +47,13 @@ create table if not exists video_hashes
 
 create unique index if not exists video_hashes_hash_entry_id_uindex
 	on video_hashes (hash, entry_id);
+
+create table if not exists chat_sync_state
+(
+    chat_id         int not null
+        constraint chat_sync_state_pk
+            primary key
+        references chats
+            on update restrict on delete restrict,
+    last_message_id int not null
+);
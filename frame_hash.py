@@ -0,0 +1,77 @@
+from typing import Set, List
+
+import numpy
+from PIL import Image
+
+# Frames are hashed at the size the difference hash needs, 9x8 pixels of 1 byte grayscale
+HASH_SIZE = 8
+FRAME_WIDTH = HASH_SIZE + 1
+FRAME_HEIGHT = HASH_SIZE
+FRAME_BYTES = FRAME_WIDTH * FRAME_HEIGHT
+# Full size frames are read from ffmpeg as 3 byte RGB pixels
+RGB_PIXEL_BYTES = 3
+
+
+def downscale_frame(frame: bytes, width: int, height: int) -> bytes:
+    """
+    Scales a full size RGB frame down to the 9x8 grayscale frame which is hashed.
+    This is done by PIL, the same way imagehash.dhash() does it, rather than by ffmpeg, whose scalers give slightly
+    different pixels, so that hashes match those stored from frame images before frames were streamed.
+    """
+    image = Image.frombuffer("RGB", (width, height), frame, "raw", "RGB", 0, 1)
+    return image.convert("L").resize((FRAME_WIDTH, FRAME_HEIGHT), Image.Resampling.LANCZOS).tobytes()
+
+
+def dhash_from_pixels(pixels: bytes) -> int:
+    """
+    Difference hash of a single 9x8 grayscale frame, with the same bits as imagehash.dhash() of that frame
+    """
+    value = 0
+    for row_start in range(0, FRAME_BYTES, FRAME_WIDTH):
+        for pixel in range(row_start, row_start + HASH_SIZE):
+            value = (value << 1) | (pixels[pixel + 1] > pixels[pixel])
+    return value
+
+
+def batch_dhash(frames: numpy.ndarray) -> numpy.ndarray:
+    """
+    Difference hashes of a batch of frames, computed in one pass
+    :param frames: An (N, 8, 9) uint8 array of grayscale frames
+    :return: An (N,) uint64 array of hashes, with the same bits as imagehash.dhash() of each frame
+    """
+    frames = numpy.asarray(frames, dtype=numpy.uint8).reshape(-1, FRAME_HEIGHT, FRAME_WIDTH)
+    diff = frames[:, :, 1:] > frames[:, :, :-1]
+    # packbits puts the first pixel comparison in the most significant bit, as imagehash does
+    packed = numpy.packbits(diff.reshape(len(frames), HASH_SIZE * HASH_SIZE), axis=1)
+    return packed.view(">u8").reshape(-1).astype(numpy.uint64)
+
+
+def hash_to_str(image_hash: int) -> str:
+    return f"{image_hash:016x}"
+
+
+class BatchFrameHasher:
+    """
+    Collects raw frames as they are decoded, and hashes them in batches.
+    """
+
+    def __init__(self, batch_size: int = 256):
+        self.batch_size = batch_size
+        self.hashes: Set[int] = set()
+        # Every frame's hash, in the order the frames were added
+        self.sequence: List[int] = []
+        self._buffer = bytearray()
+
+    def add_frame(self, frame: bytes) -> None:
+        self._buffer += frame
+        if len(self._buffer) >= self.batch_size * FRAME_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        frames = numpy.frombuffer(bytes(self._buffer), dtype=numpy.uint8)
+        batch_hashes = [int(image_hash) for image_hash in batch_dhash(frames)]
+        self.sequence.extend(batch_hashes)
+        self.hashes.update(batch_hashes)
+        self._buffer.clear()
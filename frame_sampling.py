@@ -0,0 +1,59 @@
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class FrameSamplingPolicy:
+    """
+    Decides which frames of a video to hash. Short videos are sampled at max_fps. Beyond base_duration, the number
+    of frames grows with the square root of the duration, so hash volume scales sub-linearly with video length.
+    Frames at scene changes are picked up too, if scene_threshold is set, as those are the most distinctive frames.
+    The budget is enforced as frames are selected, so neither scene changes nor a missing duration can exceed it.
+    """
+    max_fps: float
+    base_duration: float
+    scene_threshold: Optional[float] = None
+    # Only decode keyframes. Much cheaper, but depends on the video's keyframe interval
+    keyframes_only: bool = False
+
+    def frame_budget(self, duration: Optional[float]) -> float:
+        if duration is None or duration <= self.base_duration:
+            return self.max_fps * (duration or self.base_duration)
+        return self.max_fps * self.base_duration * math.sqrt(duration / self.base_duration)
+
+    def sample_interval(self, duration: Optional[float]) -> float:
+        if duration is None:
+            return 1 / self.max_fps
+        return max(1 / self.max_fps, duration / self.frame_budget(duration))
+
+    @property
+    def input_options(self) -> Optional[str]:
+        if self.keyframes_only:
+            return "-skip_frame nokey"
+        return None
+
+    def budget_expression(self) -> str:
+        """
+        An ffmpeg expression for the frame budget of the video up to the current frame's time, t.
+        At the end of a video, this is the frame budget for its whole duration.
+        """
+        return f"{self.max_fps}*if(lte(t,{self.base_duration}),t,sqrt({self.base_duration}*t))"
+
+    def select_filter(self, duration: Optional[float]) -> str:
+        interval = self.sample_interval(duration)
+        # Select the first frame, then one frame per interval
+        expression = f"isnan(prev_selected_t)+gte(t-prev_selected_t,{interval:.3f})"
+        if self.scene_threshold is not None:
+            # Also select scene changes, but not so close together that a flashing video uses the budget up at once
+            expression += f"+gt(scene,{self.scene_threshold})*gte(t-prev_selected_t,{interval / 4:.3f})"
+        # Skip frames while more have been selected than the budget so far allows, plus the first frame.
+        # This caps scene changes, and spaces frames out by the budget when the duration is unknown.
+        expression = f"({expression})*lt(selected_n,1+{self.budget_expression()})"
+        return f"select='{expression}'"
+
+
+# Used for workshops and channels the pipeline posts to
+DEFAULT_SAMPLING = FrameSamplingPolicy(max_fps=5, base_duration=30, scene_threshold=0.3)
+# Used for read only reference channels, where only reposts of whole videos need catching
+REFERENCE_SAMPLING = FrameSamplingPolicy(max_fps=2, base_duration=30, keyframes_only=True)
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, Union, Any, TypeVar, List, Optional, Coroutine, Callable
+from collections import defaultdict
+from typing import Dict, Union, Any, TypeVar, List, Optional, Coroutine, Callable, Tuple, Set
 from typing import TYPE_CHECKING
 
 from message import Message
@@ -14,6 +17,7 @@ if TYPE_CHECKING:
     from message import MessageData
 T = TypeVar('T', bound='Group')
 C = TypeVar('C', bound='ChatData')
+MessageKey = Tuple[int, bool]
 
 
 class ChatConfig(ABC):
@@ -22,11 +26,14 @@ class ChatConfig(ABC):
             handle: Union[str, int],
             *,
             queue: bool = False,
-            duplicate_detection: bool = True
+            duplicate_detection: bool = True,
+            duplicate_distance: int = 0
     ):
         self.handle = handle
         self.queue = queue
         self.duplicate_detection = duplicate_detection
+        # Maximum number of differing bits between two frame hashes for them to count as matching
+        self.duplicate_distance = duplicate_distance
         self.read_only = False
 
     @staticmethod
@@ -46,17 +53,21 @@ class ChannelConfig(ChatConfig):
             *,
             queue: bool = False,
             duplicate_detection: bool = True,
-            read_only: bool = False
+            read_only: bool = False,
+            audio_fingerprinting: bool = False
     ):
         super().__init__(handle, queue=queue, duplicate_detection=duplicate_detection)
         self.read_only = read_only
+        # Whether videos in this channel should also be checked for duplicates by their audio
+        self.audio_fingerprinting = audio_fingerprinting
 
     @staticmethod
     def from_json(json_dict) -> 'ChannelConfig':
         return ChannelConfig(
             json_dict['handle'],
             queue=json_dict['queue'],
-            read_only=json_dict.get("read_only", False)
+            read_only=json_dict.get("read_only", False),
+            audio_fingerprinting=json_dict.get("audio_fingerprinting", False)
         )
 
 
@@ -64,7 +75,11 @@ class WorkshopConfig(ChatConfig):
 
     @staticmethod
     def from_json(json_dict) -> 'WorkshopConfig':
-        return WorkshopConfig(json_dict['handle'], duplicate_detection=json_dict.get("duplicate_detection", True))
+        return WorkshopConfig(
+            json_dict['handle'],
+            duplicate_detection=json_dict.get("duplicate_detection", True),
+            duplicate_distance=json_dict.get("duplicate_distance", 0)
+        )
 
 
 class ChatData(ABC):
@@ -104,7 +119,88 @@ class WorkshopData(ChatData):
         return f"store/workshop/{self.chat_id}/"
 
 
+class ReplyTree:
+    """
+    In-memory index of which messages reply to which, within one chat. Allows walking up and down reply chains
+    without querying the database. Messages are looked up in the chat's own index, which the chat keeps up to date,
+    so this only tracks which messages reply to each message.
+    """
+
+    def __init__(self, messages: Dict[MessageKey, Message]):
+        self._messages = messages
+        # Maps the key of a message to the IDs of messages replying to it
+        self._children: Dict[MessageKey, Set[int]] = defaultdict(set)
+        for message in messages.values():
+            self.add_message(message)
+
+    @staticmethod
+    def _key(message_data: 'MessageData') -> MessageKey:
+        return message_data.message_id, message_data.is_scheduled
+
+    def __contains__(self, message_data: 'MessageData') -> bool:
+        return self._key(message_data) in self._messages
+
+    def add_message(self, message: Message) -> None:
+        message_data = message.message_data
+        if message_data.reply_to is not None:
+            self._children[(message_data.reply_to, message_data.is_scheduled)].add(message_data.message_id)
+
+    def remove_message(self, message: Message) -> None:
+        """
+        :param message: The message as it was stored, rather than from an edit, so that its parent is found
+        """
+        message_data = message.message_data
+        if message_data.reply_to is None:
+            return
+        parent_key = (message_data.reply_to, message_data.is_scheduled)
+        siblings = self._children.get(parent_key)
+        if siblings is not None:
+            siblings.discard(message_data.message_id)
+            if not siblings:
+                del self._children[parent_key]
+
+    def message_history(self, message_data: 'MessageData') -> List['MessageData']:
+        """
+        Equivalent to Database.get_message_history
+        :param message_data: the message to start climbing from
+        :return: A list of messages from the specified to the root, ordered in reverse date order
+        """
+        history = []
+        key = self._key(message_data)
+        while key in self._messages and len(history) <= len(self._messages):
+            current = self._messages[key].message_data
+            history.append(current)
+            if current.reply_to is None:
+                break
+            key = (current.reply_to, current.is_scheduled)
+        return sorted(history, key=lambda msg: msg.datetime, reverse=True)
+
+    def message_family(self, message_data: 'MessageData') -> List['MessageData']:
+        """
+        Equivalent to Database.get_message_family
+        :param message_data: The message to start descending the tree from
+        :return: A list of messages, in ascending datetime order
+        """
+        start_key = self._key(message_data)
+        if start_key not in self._messages:
+            return []
+        family = {start_key: self._messages[start_key].message_data}
+        to_visit = [start_key]
+        while to_visit:
+            message_id, is_scheduled = to_visit.pop()
+            for child_id in self._children.get((message_id, is_scheduled), set()):
+                child_key = (child_id, is_scheduled)
+                if child_key in family or child_key not in self._messages:
+                    continue
+                family[child_key] = self._messages[child_key].message_data
+                to_visit.append(child_key)
+        return sorted(family.values(), key=lambda msg: msg.datetime)
+
+
 class Group(ABC):
+    # Number of message IDs below the high-water mark which are re-fetched on an incremental sync
+    INCREMENTAL_SYNC_WINDOW = 200
+
     def __init__(
             self,
             chat_data: ChatData,
@@ -114,8 +210,12 @@ class Group(ABC):
     ):
         self.chat_data = chat_data
         self.config = config
-        self.messages = messages
         self.client = client
+        self._messages: Dict[MessageKey, Message] = {}
+        self._message_ids_by_link: Dict[str, int] = {}
+        for message in messages:
+            self._index_message(message)
+        self.reply_tree = ReplyTree(self._messages)
 
     @staticmethod
     async def load_chat_data(
@@ -134,7 +234,12 @@ class Group(ABC):
 
     @staticmethod
     async def load_messages(
-            chat_data: 'ChatData', config: 'ChatConfig', client: TelegramClient, database: 'Database'
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            *,
+            full_sync: bool = False
     ) -> List[Message]:
         logging.info(f"Initialising channel: {config}")
         # Ensure bot is in chat
@@ -142,21 +247,32 @@ class Group(ABC):
             await client.invite_pipeline_bot_to_chat(chat_data)
         # Get messages from database and channel, ensure they match
         database_messages = database.list_messages_for_chat(chat_data)
-        channel_messages = [m async for m in client.iter_channel_messages(chat_data, not config.read_only)]
-        new_messages = set(channel_messages) - set(database_messages)
-        removed_messages = set(database_messages) - set(channel_messages)
-        for message_data in new_messages:
-            database.save_message(message_data)
-        for message_data in removed_messages:
-            database.remove_message(message_data)
-        # Check files, turn message data into messages
-        messages = []
-        for message in channel_messages:
-            old_file_path = message.file_path
-            new_message = await Message.from_message_data(message, chat_data, client)
-            messages.append(new_message)
-            if old_file_path != new_message.message_data.file_path:
-                database.save_message(new_message.message_data)
+        last_message_id = database.get_last_synced_message_id(chat_data)
+        if full_sync or last_message_id is None:
+            channel_messages = await Group.full_sync_messages(chat_data, config, client, database, database_messages)
+        else:
+            channel_messages = await Group.incremental_sync_messages(
+                chat_data, config, client, database, database_messages, last_message_id
+            )
+        sent_message_ids = [msg.message_id for msg in channel_messages if not msg.is_scheduled]
+        if sent_message_ids:
+            database.save_last_synced_message_id(chat_data, max(sent_message_ids))
+        # Check files, turn message data into messages. Missing files are downloaded in parallel
+        start_time = time.monotonic()
+        old_file_paths = [message.file_path for message in channel_messages]
+        messages = list(await asyncio.gather(
+            *(Message.from_message_data(message, chat_data, client) for message in channel_messages)
+        ))
+        database.save_messages(
+            new_message.message_data
+            for old_file_path, new_message in zip(old_file_paths, messages)
+            if old_file_path != new_message.message_data.file_path
+        )
+        download_stats = client.media_downloader.chat_stats[chat_data.chat_id]
+        logging.info(
+            f"Downloaded {download_stats.files} files ({download_stats.megabytes:.1f} MB) "
+            f"for chat {chat_data.title} in {time.monotonic() - start_time:.1f} seconds"
+        )
         # Check for extra files which need removing
         dir_files = os.listdir(chat_data.directory)
         msg_files = [msg.message_data.file_path for msg in messages]
@@ -169,53 +285,169 @@ class Group(ABC):
         # Return group
         return messages
 
+    @staticmethod
+    async def full_sync_messages(
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            database_messages: List['MessageData']
+    ) -> List['MessageData']:
+        logging.info(f"Running full message sync for chat: {chat_data.title}")
+        channel_messages = [m async for m in client.iter_channel_messages(chat_data, not config.read_only)]
+        new_messages = set(channel_messages) - set(database_messages)
+        removed_messages = set(database_messages) - set(channel_messages)
+        with database.batch():
+            database.save_messages(new_messages)
+            database.remove_messages(removed_messages)
+        return channel_messages
+
+    @staticmethod
+    async def incremental_sync_messages(
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            database_messages: List['MessageData'],
+            last_message_id: int
+    ) -> List['MessageData']:
+        # Only fetch messages newer than the high-water mark, plus a window of recent messages to pick up edits and
+        # deletions. Anything older than the window is trusted from the database, until a full sync is requested.
+        min_id = max(0, last_message_id - Group.INCREMENTAL_SYNC_WINDOW)
+        logging.info(f"Running incremental message sync for chat: {chat_data.title}, from message ID {min_id}")
+        recent_messages = [
+            m async for m in client.iter_channel_messages(chat_data, not config.read_only, min_id=min_id)
+        ]
+        window_messages = {msg for msg in database_messages if msg.is_scheduled or msg.message_id > min_id}
+        removed_messages = window_messages - set(recent_messages)
+        # Save all recent messages, rather than just the new ones, so that edits are stored too
+        database_files = {msg: msg.file_path for msg in window_messages}
+        for message_data in recent_messages:
+            message_data.file_path = database_files.get(message_data)
+        with database.batch():
+            database.remove_messages(removed_messages)
+            database.save_messages(recent_messages)
+        older_messages = [
+            msg for msg in database_messages if not msg.is_scheduled and msg.message_id <= min_id
+        ]
+        return older_messages + recent_messages
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.chat_data.title})"
 
+    @property
+    def messages(self) -> List[Message]:
+        return list(self._messages.values())
+
+    def _index_message(self, message: Message) -> None:
+        message_data = message.message_data
+        self._messages[(message_data.message_id, message_data.is_scheduled)] = message
+        self._message_ids_by_link[message.telegram_link] = message_data.message_id
+
     def remove_message(self, message_data: MessageData) -> None:
-        self.messages = [msg for msg in self.messages if msg.message_data != message_data]
+        message = self._messages.pop((message_data.message_id, message_data.is_scheduled), None)
+        # Scheduled and sent messages can share an ID, and so a link
+        if message is None:
+            return
+        if self.message_by_id(message_data.message_id) is None:
+            self._message_ids_by_link.pop(message.telegram_link, None)
+        self.reply_tree.remove_message(message)
 
     @classmethod
     @abstractmethod
-    async def from_config(cls, config: 'ChatConfig', client: TelegramClient, database: 'Database'):
+    async def from_config(
+            cls, config: 'ChatConfig', client: TelegramClient, database: 'Database', *, full_sync: bool = False
+    ):
         pass
 
     @classmethod
     @abstractmethod
-    async def from_data(cls, chat_data: 'ChatData', config: 'ChatConfig', client: TelegramClient, database: 'Database'):
+    async def from_data(
+            cls,
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            *,
+            full_sync: bool = False
+    ):
         pass
 
     def message_by_id(self, message_id: int) -> Optional[Message]:
-        return next(iter([msg for msg in self.messages if msg.message_data.message_id == message_id]), None)
+        # Prefer sent messages over scheduled ones with the same ID
+        return self._messages.get((message_id, False)) or self._messages.get((message_id, True))
+
+    def messages_by_ids(self, message_ids: List[int]) -> List[Message]:
+        return [
+            self._messages[(message_id, is_scheduled)]
+            for message_id in message_ids
+            for is_scheduled in [False, True]
+            if (message_id, is_scheduled) in self._messages
+        ]
 
     def message_by_link(self, link: str) -> Optional[Message]:
-        return next(iter([msg for msg in self.messages if msg.telegram_link == link]), None)
+        message_id = self._message_ids_by_link.get(link)
+        if message_id is None:
+            return None
+        return self.message_by_id(message_id)
 
     def add_message(self, message: Message) -> None:
-        self.messages.append(message)
+        self._index_message(message)
+        self.reply_tree.add_message(message)
+
+    def message_history(self, message_data: MessageData, database: 'Database') -> List[MessageData]:
+        # Fall back to the database for messages which are not loaded in this chat
+        if message_data not in self.reply_tree:
+            return database.get_message_history(message_data)
+        return self.reply_tree.message_history(message_data)
+
+    def message_family(self, message_data: MessageData, database: 'Database') -> List[MessageData]:
+        if message_data not in self.reply_tree:
+            return database.get_message_family(message_data)
+        return self.reply_tree.message_family(message_data)
 
 
 class Channel(Group):
 
     @classmethod
-    async def from_config(cls, config: 'ChatConfig', client: TelegramClient, database: 'Database') -> Channel:
+    async def from_config(
+            cls, config: 'ChatConfig', client: TelegramClient, database: 'Database', *, full_sync: bool = False
+    ) -> Channel:
         chat_data = await Group.load_chat_data(client.get_channel_data, config, client, database)
-        return await cls.from_data(chat_data, config, client, database)
+        return await cls.from_data(chat_data, config, client, database, full_sync=full_sync)
 
     @classmethod
-    async def from_data(cls, chat_data: 'ChatData', config: 'ChatConfig', client: TelegramClient, database: 'Database'):
-        messages = await Group.load_messages(chat_data, config, client, database)
+    async def from_data(
+            cls,
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            *,
+            full_sync: bool = False
+    ):
+        messages = await Group.load_messages(chat_data, config, client, database, full_sync=full_sync)
         return Channel(chat_data, config, messages, client)
 
 
 class WorkshopGroup(Group):
 
     @classmethod
-    async def from_config(cls, config: 'ChatConfig', client: TelegramClient, database: 'Database') -> WorkshopGroup:
+    async def from_config(
+            cls, config: 'ChatConfig', client: TelegramClient, database: 'Database', *, full_sync: bool = False
+    ) -> WorkshopGroup:
         chat_data = await Group.load_chat_data(client.get_workshop_data, config, client, database)
-        return await cls.from_data(chat_data, config, client, database)
+        return await cls.from_data(chat_data, config, client, database, full_sync=full_sync)
 
     @classmethod
-    async def from_data(cls, chat_data: 'ChatData', config: 'ChatConfig', client: TelegramClient, database: 'Database'):
-        messages = await Group.load_messages(chat_data, config, client, database)
+    async def from_data(
+            cls,
+            chat_data: 'ChatData',
+            config: 'ChatConfig',
+            client: TelegramClient,
+            database: 'Database',
+            *,
+            full_sync: bool = False
+    ):
+        messages = await Group.load_messages(chat_data, config, client, database, full_sync=full_sync)
         return WorkshopGroup(chat_data, config, messages, client)
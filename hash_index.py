@@ -0,0 +1,80 @@
+from array import array
+from itertools import combinations
+from typing import Dict, Iterable, Set, List
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class HashIndex:
+    """
+    Multi-index hashing over 64-bit image hashes, for finding all stored hashes within a given hamming distance of
+    a query hash, without comparing against every stored hash.
+    Each hash is split into 4 16-bit chunks, and indexed by each chunk. Any hash within distance k of the query must
+    match at least one of the query's chunks within k // 4 bits, so only those buckets need checking.
+    Hashes are never removed, so the index may hold hashes which are no longer in the database. It is a candidate
+    filter for database lookups, not a source of truth.
+    """
+    NUM_CHUNKS = 4
+    CHUNK_BITS = 16
+    CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+    def __init__(self):
+        self._hashes: Set[int] = set()
+        self._tables: List[Dict[int, array]] = [{} for _ in range(self.NUM_CHUNKS)]
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __contains__(self, image_hash: int) -> bool:
+        return image_hash in self._hashes
+
+    def _chunks(self, image_hash: int) -> List[int]:
+        return [(image_hash >> (self.CHUNK_BITS * i)) & self.CHUNK_MASK for i in range(self.NUM_CHUNKS)]
+
+    def add(self, image_hash: int) -> None:
+        if image_hash in self._hashes:
+            return
+        self._hashes.add(image_hash)
+        for table, chunk in zip(self._tables, self._chunks(image_hash)):
+            if chunk not in table:
+                table[chunk] = array("Q")
+            table[chunk].append(image_hash)
+
+    def add_all(self, image_hashes: Iterable[int]) -> None:
+        for image_hash in image_hashes:
+            self.add(image_hash)
+
+    def _chunk_neighbours(self, chunk: int, radius: int) -> Iterable[int]:
+        yield chunk
+        for distance in range(1, radius + 1):
+            for bits in combinations(range(self.CHUNK_BITS), distance):
+                flipped = chunk
+                for bit in bits:
+                    flipped ^= 1 << bit
+                yield flipped
+
+    def find_within(self, image_hash: int, max_distance: int) -> Set[int]:
+        """
+        Lists all indexed hashes within the given hamming distance of the given hash
+        :param image_hash: The 64-bit hash to search around
+        :param max_distance: The maximum number of differing bits
+        :return: The set of matching indexed hashes, which will include the given hash if it is indexed
+        """
+        if max_distance == 0:
+            return {image_hash} if image_hash in self._hashes else set()
+        chunk_radius = max_distance // self.NUM_CHUNKS
+        matches = set()
+        for table, chunk in zip(self._tables, self._chunks(image_hash)):
+            for neighbour in self._chunk_neighbours(chunk, chunk_radius):
+                for candidate in table.get(neighbour, ()):
+                    if candidate not in matches and hamming_distance(candidate, image_hash) <= max_distance:
+                        matches.add(candidate)
+        return matches
+
+    def find_all_within(self, image_hashes: Iterable[int], max_distance: int) -> Set[int]:
+        matches = set()
+        for image_hash in image_hashes:
+            matches |= self.find_within(image_hash, max_distance)
+        return matches
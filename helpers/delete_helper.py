@@ -38,11 +38,11 @@ class DeleteHelper(Helper):
         return None
 
     async def delete_family(self, chat: Group, message: Message) -> Optional[List[Message]]:
-        message_history = self.database.get_message_history(message.message_data)
+        message_history = chat.message_history(message.message_data, self.database)
         return await self.delete_branch(chat, message_history[-1])
 
     async def delete_branch(self, chat: Group, message: MessageData) -> Optional[List[Message]]:
-        message_family = self.database.get_message_family(message)
+        message_family = chat.message_family(message, self.database)
         for msg_data in message_family:
             msg = chat.message_by_id(msg_data.message_id)
             await self.client.delete_message(msg_data)
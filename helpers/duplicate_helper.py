@@ -1,81 +1,177 @@
+import asyncio
 import glob
-import os
-import shutil
-from typing import Optional, List, Set
+import hashlib
+import json
+import logging
+import time
+from typing import Optional, List, Set, Dict, Tuple
 
 import imagehash
 from PIL import Image
 
+from audio_fingerprint import AudioFingerprint, AudioMatch, fingerprint_pcm, match_fingerprints, SAMPLE_RATE, \
+    SAMPLE_BYTES, HOP_SIZE
 from database import Database
-from group import WorkshopGroup, Group
+from frame_hash import BatchFrameHasher, downscale_frame, RGB_PIXEL_BYTES
+from frame_sampling import FrameSamplingPolicy, DEFAULT_SAMPLING, REFERENCE_SAMPLING
+from group import WorkshopGroup, Group, Channel
+from hash_index import HashIndex
 from helpers.helpers import Helper
 from message import Message, MessageData
-from tasks.ffmpeg_task import FfmpegTask
-from tasks.task_worker import TaskWorker
+from sequence_match import FrameSequence, SequenceMatch, align_sequences
+from tasks.ffmpeg_frames_task import FfmpegFramesTask
+from tasks.ffmprobe_task import FFprobeTask
+from tasks.task_worker import TaskWorker, TaskPriority, task_priority
 from telegram_client import TelegramClient
 
 
+def file_digest(file_path: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def format_video_time(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
 class DuplicateHelper(Helper):
-    blank_frame_hash = "0000000000000000"
+    blank_frame_hash = 0
+    # Number of videos the background backfill hashes at once
+    BACKFILL_CONCURRENCY = 2
+    # Number of videos between backfill progress log lines
+    BACKFILL_LOG_INTERVAL = 50
+    # An aligned match needs this many frames, and this fraction of the frames in its range, to raise a warning
+    MIN_MATCHED_FRAMES = 3
+    MIN_MATCH_SCORE = 0.5
+    # An audio match needs this many fingerprints at the same offset, and this fraction of the new video's fingerprints
+    MIN_AUDIO_MATCHED_FINGERPRINTS = 20
+    MIN_AUDIO_MATCH_SCORE = 0.05
 
-    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker):
+    def __init__(self, database: Database, client: TelegramClient, worker: TaskWorker, channels: List[Channel]):
         super().__init__(database, client, worker)
+        self.hash_index = HashIndex()
+        self.reference_chat_ids = {channel.chat_data.chat_id for channel in channels if channel.config.read_only}
+        self.channel_chat_ids = {channel.chat_data.chat_id for channel in channels}
+        self.audio_chat_ids = {
+            channel.chat_data.chat_id for channel in channels if channel.config.audio_fingerprinting
+        }
+
+    def initialise_hashes(self) -> None:
+        # Load existing hashes into the index
+        self.hash_index.add_all(self.database.list_distinct_hashes())
 
-    async def initialise_hashes(self, workshops: List[WorkshopGroup]):
-        # Initialise, get all channels, get all videos, decompose all, add to the master hash
+    async def backfill_hashes(self, workshops: List[WorkshopGroup]) -> None:
+        """
+        Hashes every video which does not have hashes yet. Each video's hashes are saved as soon as they are created,
+        so if the backfill is interrupted, the next one carries on from the videos which are still missing hashes.
+        """
         workshop_ids = {workshop.chat_data.chat_id: workshop for workshop in workshops}
-        messages_needing_hashes = self.database.get_messages_needing_hashing()
-        for message_data in messages_needing_hashes:
+        messages_needing_hashes = [
+            message_data for message_data in self.database.get_messages_needing_hashing()
             # Skip any messages in workshops which are disabled
-            workshop = workshop_ids.get(message_data.chat_id)
-            if workshop is not None and not workshop.config.duplicate_detection:
-                continue
-            # Create hashes for message
-            new_hashes = await self.create_message_hashes(message_data)
-            # Send alerts for workshop messages
-            if workshop is not None:
-                message = workshop.message_by_id(message_data.message_id)
+            if message_data.chat_id not in workshop_ids or workshop_ids[message_data.chat_id].config.duplicate_detection
+        ]
+        # Videos which are being hashed will be fingerprinted at the same time, if they need it
+        messages_needing_fingerprints = []
+        if self.audio_chat_ids:
+            hashing_messages = set(messages_needing_hashes)
+            messages_needing_fingerprints = [
+                message_data
+                for message_data in self.database.get_messages_needing_audio_fingerprints(self.audio_chat_ids)
+                if message_data not in hashing_messages
+            ]
+        total = len(messages_needing_hashes) + len(messages_needing_fingerprints)
+        if total == 0:
+            return
+        logging.info(
+            f"Backfilling hashes for {len(messages_needing_hashes)} videos, "
+            f"and audio fingerprints for {len(messages_needing_fingerprints)} more"
+        )
+        start_time = time.monotonic()
+        semaphore = asyncio.Semaphore(self.BACKFILL_CONCURRENCY)
+        completed = 0
+
+        async def backfill_message(message_data: MessageData, fingerprint_only: bool = False) -> None:
+            nonlocal completed
+            async with semaphore:
+                try:
+                    if fingerprint_only:
+                        await self.create_audio_fingerprints(message_data)
+                    else:
+                        await self.backfill_message_hashes(message_data, workshop_ids.get(message_data.chat_id))
+                except Exception as e:
+                    logging.warning(f"Failed to backfill hashes for message {message_data}", exc_info=e)
+            completed += 1
+            if completed % self.BACKFILL_LOG_INTERVAL == 0 or completed == total:
+                elapsed = time.monotonic() - start_time
+                queue_depths = ", ".join(
+                    f"{priority.name.lower()}: {depth}" for priority, depth in self.worker.queue_depths.items()
+                )
+                logging.info(
+                    f"Backfilled hashes for {completed}/{total} videos in {elapsed:.0f} seconds, "
+                    f"{completed / elapsed:.2f} videos per second. Queued tasks by priority: {queue_depths}"
+                )
+
+        # Backfill tasks yield to anything a user is waiting on
+        with task_priority(TaskPriority.BACKGROUND):
+            await asyncio.gather(
+                *(backfill_message(message_data) for message_data in messages_needing_hashes),
+                *(backfill_message(message_data, True) for message_data in messages_needing_fingerprints)
+            )
+
+    async def backfill_message_hashes(self, message_data: MessageData, workshop: Optional[WorkshopGroup]) -> None:
+        # Videos hashed before frame sequences were stored are hashed again, but were already checked for duplicates
+        already_checked = self.get_message_hashes(message_data) is not None
+        # Create hashes for message
+        new_hashes = await self.create_message_hashes(message_data)
+        # Send alerts for workshop messages
+        if workshop is not None and not already_checked:
+            message = workshop.message_by_id(message_data.message_id)
+            if message is not None:
                 await self.check_hash_in_store(workshop, new_hashes, message)
 
-    async def get_or_create_message_hashes(self, message_data: MessageData) -> Set[str]:
+    async def get_or_create_message_hashes(self, message_data: MessageData) -> Set[int]:
         existing_hashes = self.get_message_hashes(message_data)
         if existing_hashes is not None:
             return set(existing_hashes)
         return await self.create_message_hashes(message_data)
 
-    def get_message_hashes(self, message_data: MessageData) -> Optional[List[str]]:
+    def get_message_hashes(self, message_data: MessageData) -> Optional[List[int]]:
         hashes = self.database.get_hashes_for_message(message_data)
         if hashes:
             return hashes
         return None
 
-    async def create_message_hashes(self, message_data: MessageData) -> Set[str]:
+    async def create_message_hashes(self, message_data: MessageData) -> Set[int]:
         if not message_data.has_video:
             return set()
-        message_decompose_path = f"sandbox/decompose/{message_data.chat_id}-{message_data.message_id}/"
-        # Decompose video into images
-        os.makedirs(message_decompose_path, exist_ok=True)
-        await self.decompose_video(message_data.file_path, message_decompose_path)
-        # Hash the images
-        hashes = set()
-        for image_file in glob.glob(f"{message_decompose_path}/*.png"):
-            image = Image.open(image_file)
-            image_hash = str(imagehash.dhash(image))
-            hashes.add(image_hash)
-        # Delete the images
-        try:
-            shutil.rmtree(message_decompose_path)
-        except FileNotFoundError:
-            pass
-        # Save hashes
-        self.database.save_hashes(message_data, hashes)
+        # Sent and forwarded videos are byte-identical copies of stored files, so reuse those hashes where possible
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(None, file_digest, message_data.file_path)
+        sequence = self.database.get_frame_sequence_for_digest(digest)
+        if sequence is None:
+            # Hash the frames of the video as ffmpeg decodes them
+            sequence = await self.hash_video_frames(message_data.file_path, self.sampling_for_message(message_data))
+        hashes = set(sequence.hashes)
+        # Save hashes in one transaction. The frame sequence marks the message as hashed, so it is written last
+        with self.database.batch():
+            self.database.save_file_digest(message_data, digest)
+            self.database.save_hashes(message_data, hashes)
+            self.database.save_frame_sequence(message_data, sequence)
+        self.hash_index.add_all(hashes)
+        if self.needs_audio_fingerprints(message_data):
+            await self.create_audio_fingerprints(message_data, digest)
         # Return hashes
         return hashes
 
     async def check_hash_in_store(
             self,
             chat: WorkshopGroup,
-            image_hashes: Set[str],
+            image_hashes: Set[int],
             message: Message
     ) -> Optional[Message]:
         if not image_hashes:
@@ -83,33 +179,189 @@ class DuplicateHelper(Helper):
         has_blank_frame = self.blank_frame_hash in image_hashes
         if has_blank_frame:
             image_hashes.remove(self.blank_frame_hash)
-        matching_messages = set(self.database.get_messages_for_hashes(image_hashes))
         # Get root parent
-        msg_history = self.database.get_message_history(message.message_data)
-        msg_family = set(self.database.get_message_family(msg_history[-1]))
+        msg_history = chat.message_history(message.message_data, self.database)
+        msg_family = set(chat.message_family(msg_history[-1], self.database))
         # warning messages
-        warning_messages = matching_messages - msg_family
+        warning_messages = await self.find_duplicate_messages(
+            message.message_data,
+            image_hashes,
+            chat.config.duplicate_distance,
+            msg_family
+        )
+        audio_warning_messages = {
+            match_message: audio_match
+            for match_message, audio_match in (await self.find_audio_matches(message.message_data)).items()
+            if match_message not in msg_family
+        }
         warning_msg = None
-        if len(warning_messages) > 0 or has_blank_frame:
-            warning_msg = await self.post_duplicate_warning(chat, message, warning_messages, has_blank_frame)
+        if len(warning_messages) > 0 or len(audio_warning_messages) > 0 or has_blank_frame:
+            warning_msg = await self.post_duplicate_warning(
+                chat, message, warning_messages, has_blank_frame, audio_warning_messages
+            )
         return warning_msg
 
+    def needs_audio_fingerprints(self, message_data: MessageData) -> bool:
+        # Videos in audio channels are fingerprinted to be matched against, and workshop videos to match against them
+        if message_data.chat_id in self.audio_chat_ids:
+            return True
+        return len(self.audio_chat_ids) > 0 and message_data.chat_id not in self.channel_chat_ids
+
+    async def create_audio_fingerprints(
+            self,
+            message_data: MessageData,
+            digest: Optional[bytes] = None
+    ) -> List[AudioFingerprint]:
+        fingerprints = None
+        if digest is not None:
+            fingerprints = self.database.get_audio_fingerprints_for_digest(digest)
+        if fingerprints is None:
+            fingerprints = await self.fingerprint_audio(message_data.file_path)
+        self.database.save_audio_fingerprints(message_data, fingerprints)
+        return fingerprints
+
+    async def has_audio(self, video_path: str) -> bool:
+        probe_task = FFprobeTask(
+            global_options=["-v error"],
+            inputs={video_path: "-select_streams a -show_entries stream=index -of csv=p=0"}
+        )
+        return len(await self.worker.await_task(probe_task)) > 0
+
+    async def fingerprint_audio(self, video_path: str) -> List[AudioFingerprint]:
+        # ffmpeg fails if there is no audio stream to output
+        if not await self.has_audio(video_path):
+            return []
+        pcm = bytearray()
+        task = FfmpegFramesTask(
+            HOP_SIZE * SAMPLE_BYTES,
+            pcm.extend,
+            inputs={video_path: None},
+            output_options=f"-vn -ac 1 -ar {SAMPLE_RATE} -f s16le -acodec pcm_s16le"
+        )
+        await self.worker.await_task(task)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fingerprint_pcm, bytes(pcm))
+
+    async def find_audio_matches(self, message_data: MessageData) -> Dict[MessageData, AudioMatch]:
+        if not message_data.has_video or not self.needs_audio_fingerprints(message_data):
+            return {}
+        fingerprints = self.database.get_audio_fingerprints(message_data)
+        if fingerprints is None:
+            fingerprints = await self.create_audio_fingerprints(message_data)
+        if not fingerprints:
+            return {}
+        stored_fingerprints = self.database.get_audio_fingerprints_for_hashes(
+            {fingerprint_hash for fingerprint_hash, _ in fingerprints},
+            self.audio_chat_ids
+        )
+        return {
+            match_message: audio_match
+            for match_message, audio_match in match_fingerprints(fingerprints, stored_fingerprints).items()
+            if audio_match.matched_fingerprints >= self.MIN_AUDIO_MATCHED_FINGERPRINTS
+            and audio_match.score >= self.MIN_AUDIO_MATCH_SCORE
+        }
+
+    async def find_duplicate_messages(
+            self,
+            message_data: MessageData,
+            image_hashes: Set[int],
+            max_distance: int,
+            excluded: Set[MessageData]
+    ) -> Dict[MessageData, Optional[SequenceMatch]]:
+        """
+        Finds stored videos sharing frame hashes with a message's video, other than the excluded ones, and aligns
+        them against it, keeping those which match
+        """
+        matching_hashes = self.find_matching_hashes(image_hashes, max_distance)
+        candidates = set(self.database.get_messages_for_hashes(matching_hashes)) - excluded
+        return await self.align_matching_messages(message_data, candidates, max_distance)
+
+    async def align_matching_messages(
+            self,
+            message_data: MessageData,
+            candidates: Set[MessageData],
+            max_distance: int
+    ) -> Dict[MessageData, Optional[SequenceMatch]]:
+        """
+        Aligns the frame sequence of a message's video against each candidate which shares frame hashes with it, and
+        keeps those where enough of the frames line up. Candidates hashed before frame sequences were stored cannot
+        be aligned, so are kept without a match.
+        """
+        query_sequence = self.database.get_frame_sequence(message_data)
+        candidate_sequences = {candidate: self.database.get_frame_sequence(candidate) for candidate in candidates}
+        # Aligning long videos takes a while, so is done off the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.align_sequences_to_query, query_sequence, candidate_sequences, max_distance
+        )
+
+    def align_sequences_to_query(
+            self,
+            query_sequence: Optional[FrameSequence],
+            candidate_sequences: Dict[MessageData, Optional[FrameSequence]],
+            max_distance: int
+    ) -> Dict[MessageData, Optional[SequenceMatch]]:
+        matches = {}
+        for candidate, candidate_sequence in candidate_sequences.items():
+            if query_sequence is None or candidate_sequence is None:
+                matches[candidate] = None
+                continue
+            match = align_sequences(
+                query_sequence,
+                candidate_sequence,
+                max_distance,
+                ignore_hashes=frozenset({self.blank_frame_hash})
+            )
+            if match is None:
+                continue
+            min_frames = min(self.MIN_MATCHED_FRAMES, len(query_sequence))
+            if match.matched_frames >= min_frames and match.score >= self.MIN_MATCH_SCORE:
+                matches[candidate] = match
+        return matches
+
+    def find_matching_hashes(self, image_hashes: Set[int], max_distance: int) -> Set[int]:
+        # Only stored hashes are returned, so the database lookup skips hashes which cannot match
+        return self.hash_index.find_all_within(image_hashes, max_distance) - {self.blank_frame_hash}
+
     async def post_duplicate_warning(
             self,
             chat: Group,
             new_message: Message,
-            potential_matches: Set[MessageData],
-            has_blank_frame: bool
+            potential_matches: Dict[MessageData, Optional[SequenceMatch]],
+            has_blank_frame: bool,
+            audio_matches: Optional[Dict[MessageData, AudioMatch]] = None
     ) -> Message:
         warning_messages = []
         if has_blank_frame:
             warning_messages.append("This video contains at least one blank frame.")
         if potential_matches:
             message_links = []
-            for message in potential_matches:
+            # List the closest matches first
+            for message, match in sorted(
+                    potential_matches.items(),
+                    key=lambda item: -1 if item[1] is None else item[1].score,
+                    reverse=True
+            ):
                 chat_data = self.database.get_chat_by_id(message.chat_id) or chat.chat_data
-                message_links.append(chat_data.telegram_link_for_message(message))
+                message_link = chat_data.telegram_link_for_message(message)
+                if match is not None:
+                    message_link += (
+                        f" ({match.score:.0%} similar, "
+                        f"{format_video_time(match.query_start)}-{format_video_time(match.query_end)} "
+                        f"matches {format_video_time(match.match_start)}-{format_video_time(match.match_end)})"
+                    )
+                message_links.append(message_link)
             warning_messages.append("This video might be a duplicate of:\n" + "\n".join(message_links))
+        if audio_matches:
+            message_links = []
+            for message, audio_match in sorted(audio_matches.items(), key=lambda item: item[1].score, reverse=True):
+                chat_data = self.database.get_chat_by_id(message.chat_id) or chat.chat_data
+                start_time = format_video_time(max(audio_match.offset, 0))
+                message_links.append(
+                    f"{chat_data.telegram_link_for_message(message)} "
+                    f"({audio_match.matched_fingerprints} matching fingerprints, from {start_time})"
+                )
+            warning_messages.append("This video's audio might be a duplicate of:\n" + "\n".join(message_links))
         return await self.send_text_reply(chat, new_message, "\n".join(warning_messages))
 
     @staticmethod
@@ -121,13 +373,69 @@ class DuplicateHelper(Helper):
             hashes.append(image_hash)
         return hashes
 
-    async def decompose_video(self, video_path: str, decompose_dir_path: str):
-        task = FfmpegTask(
-            inputs={video_path: None},
-            outputs={f"{decompose_dir_path}/out%d.png": "-vf fps=5 -vsync 0"},
-            global_options="-y"
+    def sampling_for_message(self, message_data: MessageData) -> FrameSamplingPolicy:
+        if message_data.chat_id in self.reference_chat_ids:
+            return REFERENCE_SAMPLING
+        return DEFAULT_SAMPLING
+
+    async def video_duration(self, video_path: str) -> Optional[float]:
+        probe_task = FFprobeTask(
+            global_options=["-v error"],
+            inputs={video_path: "-show_entries format=duration -of default=noprint_wrappers=1:nokey=1"}
+        )
+        try:
+            return float(await self.worker.await_task(probe_task))
+        except ValueError:
+            # Some formats, such as gifs, may not report a duration
+            return None
+
+    async def video_dimensions(self, video_path: str) -> Tuple[int, int]:
+        """Width and height of the frames ffmpeg decodes from a video, which are swapped if it is rotated 90 degrees"""
+        probe_task = FFprobeTask(
+            global_options=["-v error"],
+            inputs={video_path: (
+                "-select_streams v:0 -show_entries stream=width,height:stream_tags=rotate:stream_side_data=rotation "
+                "-of json"
+            )}
+        )
+        stream = json.loads(await self.worker.await_task(probe_task))["streams"][0]
+        # Older ffmpeg versions report rotation as a tag, newer ones as side data
+        rotation = int(stream.get("tags", {}).get("rotate", 0))
+        for side_data in stream.get("side_data_list", []):
+            rotation = int(side_data.get("rotation", rotation))
+        if rotation % 180:
+            return stream["height"], stream["width"]
+        return stream["width"], stream["height"]
+
+    async def hash_video_frames(self, video_path: str, sampling: FrameSamplingPolicy) -> FrameSequence:
+        duration = await self.video_duration(video_path)
+        width, height = await self.video_dimensions(video_path)
+        hasher = BatchFrameHasher()
+        frame_times = []
+        loop = asyncio.get_event_loop()
+
+        async def add_frame(frame: bytes) -> None:
+            # Frames are scaled down by PIL, off the event loop, so hashes match those made before frames were streamed
+            hasher.add_frame(await loop.run_in_executor(None, downscale_frame, frame, width, height))
+
+        # showinfo logs the time of each selected frame
+        video_filter = f"{sampling.select_filter(duration)},showinfo"
+        task = FfmpegFramesTask(
+            width * height * RGB_PIXEL_BYTES,
+            add_frame,
+            on_frame_time=frame_times.append,
+            inputs={video_path: sampling.input_options},
+            output_options=f"-vf \"{video_filter}\" -vsync 0 -f rawvideo -pix_fmt rgb24"
         )
         await self.worker.await_task(task)
+        hasher.flush()
+        if len(frame_times) != len(hasher.sequence):
+            logging.warning(
+                f"Read {len(hasher.sequence)} frames but {len(frame_times)} frame times when hashing {video_path}"
+            )
+            num_frames = min(len(frame_times), len(hasher.sequence))
+            return FrameSequence(hasher.sequence[:num_frames], frame_times[:num_frames])
+        return FrameSequence(hasher.sequence, frame_times)
 
     async def on_new_message(self, chat: Group, message: Message) -> Optional[List[Message]]:
         # If message has a video, decompose it if necessary, then check images against master hash
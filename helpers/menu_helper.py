@@ -45,6 +45,7 @@ class MenuHelper(Helper):
         menu = self.menu_cache.get_menu_by_video(video)
         if menu:
             await self.client.delete_message(menu.msg.message_data)
+            menu.menu.chat.remove_message(menu.msg.message_data)
             menu.msg.delete(self.database)
             self.menu_cache.remove_menu_by_video(video)
 
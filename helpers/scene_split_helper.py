@@ -9,7 +9,7 @@ from group import Group
 from helpers.helpers import find_video_for_message
 from helpers.video_cut_helper import VideoCutHelper
 from message import Message
-from tasks.task_worker import TaskWorker
+from tasks.task_worker import TaskWorker, TaskPriority, task_priority
 from telegram_client import TelegramClient
 
 if TYPE_CHECKING:
@@ -78,13 +78,15 @@ class SceneSplitHelper(VideoCutHelper):
             video: Message,
             scene_list: List[Tuple[FrameTimecode, FrameTimecode]]
     ) -> Optional[List[Message]]:
-        cut_videos = await asyncio.gather(*[
-            self.cut_video(
-                video,
-                start_time.get_timecode(),
-                end_time.previous_frame().get_timecode()
-            ) for (start_time, end_time) in scene_list
-        ])
+        # Splitting can create dozens of cuts, which should not hold up other users' commands
+        with task_priority(TaskPriority.USER_BULK):
+            cut_videos = await asyncio.gather(*[
+                self.cut_video(
+                    video,
+                    start_time.get_timecode(),
+                    end_time.previous_frame().get_timecode()
+                ) for (start_time, end_time) in scene_list
+            ])
         video_replies = []
         for new_path in cut_videos:
             video_replies.append(await self.send_video_reply(chat, message, new_path))
@@ -46,7 +46,7 @@ class GifSendHelper(Helper):
         await self.menu_helper.delete_menu_for_video(video)
         # Read dest string
         dest_str = text_clean[4:].strip()
-        if not was_giffed(self.database, video):
+        if not was_giffed(self.database, chat, video):
             return await self.menu_helper.send_not_gif_warning_menu(chat, message, video, self, dest_str)
         return await self.handle_dest_str(chat, message, video, dest_str, message.message_data.sender_id)
 
@@ -195,8 +195,8 @@ class GifSendHelper(Helper):
         return new_message
 
 
-def was_giffed(database: Database, video: Message) -> bool:
-    message_history = database.get_message_history(video.message_data)
+def was_giffed(database: Database, chat: Group, video: Message) -> bool:
+    message_history = chat.message_history(video.message_data, database)
     if len(message_history) < 2:
         return False
     latest_command = message_history[1].text
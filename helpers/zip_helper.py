@@ -9,6 +9,7 @@ from helpers.helpers import random_sandbox_video_path
 from helpers.telegram_gif_helper import TelegramGifHelper
 from message import Message, mime_type_is_video
 from tasks.ffmpeg_task import FfmpegTask
+from tasks.task_worker import TaskPriority, task_priority
 
 
 class ZipHelper(TelegramGifHelper):
@@ -31,8 +32,9 @@ class ZipHelper(TelegramGifHelper):
                     with zip_ref.open(filename) as zf, open(video_path, "wb") as f:
                         shutil.copyfileobj(zf, f)
                     video_paths.append(video_path)
-        # Convert to mp4s
-        processed_paths = await asyncio.gather(*(self.convert_file(path) for path in video_paths))
+        # Convert to mp4s, without holding up other users' commands if there are many
+        with task_priority(TaskPriority.USER_BULK):
+            processed_paths = await asyncio.gather(*(self.convert_file(path) for path in video_paths))
         # Send them
         if processed_paths:
             return await asyncio.gather(*(self.send_video_reply(chat, message, path) for path in processed_paths))
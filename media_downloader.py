@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
+from typing import Callable, Coroutine, Optional, Dict, Deque, Tuple
+
+from message import MessageData
+
+DownloadJob = Tuple[MessageData, str, asyncio.Future]
+
+
+@dataclass
+class DownloadStats:
+    files: int = 0
+    bytes: int = 0
+
+    def add_file(self, file_path: str) -> None:
+        self.files += 1
+        self.bytes += os.path.getsize(file_path)
+
+    @property
+    def megabytes(self) -> float:
+        return self.bytes / 1_000_000
+
+
+class MediaDownloader:
+    """
+    Runs media downloads with a bounded number of downloads in flight at once. Queued downloads are taken from each
+    chat in turn, so that one chat with a large backlog does not starve the others.
+    """
+
+    def __init__(
+            self,
+            download_func: Callable[[MessageData, str], Coroutine[None, None, Optional[str]]],
+            num_concurrent: int
+    ):
+        self.download_func = download_func
+        self.num_concurrent = num_concurrent
+        self._queues: 'OrderedDict[int, Deque[DownloadJob]]' = OrderedDict()
+        self._num_workers = 0
+        self.chat_stats: Dict[int, DownloadStats] = defaultdict(DownloadStats)
+
+    @property
+    def total_stats(self) -> DownloadStats:
+        return DownloadStats(
+            sum(stats.files for stats in self.chat_stats.values()),
+            sum(stats.bytes for stats in self.chat_stats.values())
+        )
+
+    async def download(self, message_data: MessageData, path: str) -> Optional[str]:
+        future = asyncio.get_event_loop().create_future()
+        chat_id = message_data.chat_id
+        if chat_id not in self._queues:
+            self._queues[chat_id] = deque()
+        self._queues[chat_id].append((message_data, path, future))
+        if self._num_workers < self.num_concurrent:
+            self._num_workers += 1
+            asyncio.ensure_future(self._worker())
+        return await future
+
+    def _next_job(self) -> Tuple[int, DownloadJob]:
+        # Take a job from the chat at the front, then move that chat to the back of the queue
+        chat_id, queue = self._queues.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            self._queues[chat_id] = queue
+        return chat_id, job
+
+    async def _worker(self) -> None:
+        try:
+            while self._queues:
+                chat_id, (message_data, path, future) = self._next_job()
+                if future.done():
+                    continue
+                try:
+                    result = await self.download_func(message_data, path)
+                except Exception as e:
+                    logging.warning(f"Failed to download media for message {message_data}")
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if result is not None and os.path.exists(result):
+                    self.chat_stats[chat_id].add_file(result)
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._num_workers -= 1
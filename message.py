@@ -3,6 +3,7 @@ from __future__ import annotations
 import datetime
 import logging
 import os
+from dataclasses import dataclass
 from typing import Optional
 from typing import TYPE_CHECKING
 
@@ -16,6 +17,18 @@ def mime_type_is_video(mime_type: str) -> bool:
     return mime_type.startswith("video") or mime_type == "image/gif"
 
 
+@dataclass
+class MediaLocator:
+    """
+    The details needed to download a message's document from telegram, without fetching the whole message.
+    """
+    document_id: int
+    access_hash: int
+    file_reference: bytes
+    file_size: int
+    dc_id: int
+
+
 class MessageData:
     def __init__(
             self,
@@ -29,7 +42,8 @@ class MessageData:
             file_mime_type: Optional[str],
             reply_to: Optional[int],
             sender_id: int,
-            is_scheduled: bool
+            is_scheduled: bool,
+            media_locator: Optional[MediaLocator] = None
     ):
         self.chat_id = chat_id
         self.message_id = message_id
@@ -42,6 +56,7 @@ class MessageData:
         self.reply_to = reply_to
         self.sender_id = sender_id
         self.is_scheduled = is_scheduled
+        self.media_locator = media_locator
 
     def __repr__(self) -> str:
         return f"MessageData(chat_id={self.chat_id or self.chat_id}, message_id={self.message_id})"
@@ -94,12 +109,12 @@ class Message:
                 video_path = message_data.expected_file_path(chat_data)
                 if not os.path.exists(video_path):
                     logging.info(f"Downloading video from message: {message_data}")
-                    await client.download_media(message_data.chat_id, message_data.message_id, video_path)
+                    await client.download_media(message_data, video_path)
                 message_data.file_path = video_path
             else:
                 if not os.path.exists(message_data.file_path):
                     logging.info(f"Downloading video from message: {message_data}")
-                    await client.download_media(message_data.chat_id, message_data.message_id, message_data.file_path)
+                    await client.download_media(message_data, message_data.file_path)
         # Create message
         return Message(message_data, chat_data)
 
@@ -0,0 +1,7 @@
+-- Used by the recursive reply tree queries, get_message_family in particular
+create index if not exists messages_chat_id_reply_to_is_scheduled_index
+    on messages (chat_id, reply_to, is_scheduled);
+
+-- Used by the joins from messages to their hashes, and when removing a message's hashes
+create index if not exists video_hashes_entry_id_index
+    on video_hashes (entry_id);
@@ -0,0 +1,7 @@
+-- Store message dates as integer unix timestamps, which are far cheaper to decode than date strings
+alter table messages add column timestamp integer;
+
+update messages set timestamp = cast(strftime('%s', datetime) as integer) where datetime is not null;
+
+-- The text column is no longer written or read, so clear it out rather than storing every date twice
+update messages set datetime = null;
@@ -0,0 +1,14 @@
+-- Enough to download a message's document without fetching the message from telegram first
+create table if not exists media_locators
+(
+    entry_id       integer not null
+        constraint media_locators_pk
+            primary key
+        references messages
+            on update restrict on delete restrict,
+    document_id    integer not null,
+    access_hash    integer not null,
+    file_reference blob    not null,
+    file_size      integer not null,
+    dc_id          integer not null
+);
@@ -0,0 +1,22 @@
+-- Store frame hashes as signed 64-bit integers, rather than 16 character hex strings.
+-- SQLite cannot change a column's type in place, so the table is rebuilt.
+create table video_hashes_new
+(
+    hash     integer not null,
+    entry_id integer not null
+        references messages
+            on update restrict on delete restrict
+);
+
+insert or ignore into video_hashes_new (hash, entry_id)
+select hex_hash_to_int(hash), entry_id from video_hashes;
+
+drop table video_hashes;
+
+alter table video_hashes_new rename to video_hashes;
+
+create unique index video_hashes_hash_entry_id_uindex
+    on video_hashes (hash, entry_id);
+
+create index video_hashes_entry_id_index
+    on video_hashes (entry_id);
@@ -0,0 +1,13 @@
+-- Content digest of each message's stored file, so byte-identical copies can reuse existing frame hashes
+create table if not exists file_digests
+(
+    entry_id integer not null
+        constraint file_digests_pk
+            primary key
+        references messages
+            on update restrict on delete restrict,
+    digest   blob    not null
+);
+
+create index if not exists file_digests_digest_index
+    on file_digests (digest);
@@ -0,0 +1,12 @@
+-- Ordered frame hashes and frame times of each hashed video, for aligning a new video against candidate matches.
+-- Hashes are packed as little endian unsigned 64-bit integers, and frame times as little endian 32-bit floats.
+create table if not exists video_frame_sequences
+(
+    entry_id    integer not null
+        constraint video_frame_sequences_pk
+            primary key
+        references messages
+            on update restrict on delete restrict,
+    hashes      blob    not null,
+    frame_times blob    not null
+);
@@ -0,0 +1,25 @@
+-- Spectral peak pair fingerprints of each fingerprinted message's audio, with the frame offset of each within the audio
+create table if not exists audio_fingerprints
+(
+    hash         integer not null,
+    entry_id     integer not null
+        references messages
+            on update restrict on delete restrict,
+    frame_offset integer not null
+);
+
+create index if not exists audio_fingerprints_hash_index
+    on audio_fingerprints (hash);
+
+create index if not exists audio_fingerprints_entry_id_index
+    on audio_fingerprints (entry_id);
+
+-- Messages which have been fingerprinted, as silent videos have no fingerprints
+create table if not exists audio_fingerprinted_messages
+(
+    entry_id integer not null
+        constraint audio_fingerprinted_messages_pk
+            primary key
+        references messages
+            on update restrict on delete restrict
+);
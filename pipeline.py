@@ -1,8 +1,11 @@
 import asyncio
 import json
 import logging
+import os
+import signal
 import sys
-from typing import Dict, List, Iterator, Optional, Iterable, Union
+import time
+from typing import Dict, List, Iterator, Optional, Iterable, Union, KeysView, Tuple
 
 from telethon import events
 
@@ -29,7 +32,10 @@ from helpers.video_rotate_helper import VideoRotateHelper
 from helpers.zip_helper import ZipHelper
 from menu_cache import MenuCache
 from message import Message
-from tasks.task_worker import TaskWorker
+from tasks.concurrency_governor import ConcurrencyGovernor
+from tasks.process_group import kill_all_process_groups
+from tasks.task import ResourceClass
+from tasks.task_worker import TaskWorker, task_owners
 from telegram_client import TelegramClient, message_data_from_telegram, chat_id_from_telegram
 
 
@@ -46,16 +52,57 @@ class PipelineConfig:
         self.public_bot_token = config.get("public_bot_token")
         # API keys for external services
         self.api_keys = config.get("api_keys", {})
+        # Whether to walk the entire history of every chat on startup, rather than syncing incrementally
+        self.full_sync = config.get("full_sync", False)
+        # Number of media files to download at once while initialising chats
+        self.max_concurrent_downloads = config.get("max_concurrent_downloads", 4)
+        # Number of tasks to run at once for each resource class, overriding the defaults based on the number of cores
+        self.worker_pool_sizes = {
+            ResourceClass(resource_class): pool_size
+            for resource_class, pool_size in config.get("worker_pools", {}).items()
+        }
+        # Bounds on the number of ffmpeg tasks in each CPU bound pool, as the governor adjusts it to the machine's load
+        governor_config = config.get("concurrency_governor", {})
+        self.concurrency_limits = (governor_config.get("floor", 1), governor_config.get("ceiling", os.cpu_count() or 1))
+        # Maximum memory each ffmpeg process may use, in megabytes, or no limit if not set
+        self.ffmpeg_memory_limit_mb: Optional[int] = config.get("ffmpeg_memory_limit_mb")
+        # Seconds a task of each resource class may run for before it is cancelled, overriding the defaults
+        self.task_timeouts = {
+            ResourceClass(resource_class): timeout
+            for resource_class, timeout in config.get("task_timeouts", {}).items()
+        }
 
     def initialise_pipeline(self) -> 'Pipeline':
         database = Database()
-        client = TelegramClient(self.api_id, self.api_hash, self.pipeline_bot_token, self.public_bot_token)
+        client = TelegramClient(
+            self.api_id,
+            self.api_hash,
+            self.pipeline_bot_token,
+            self.public_bot_token,
+            self.max_concurrent_downloads,
+            on_media_locator_refreshed=database.save_media_locator
+        )
         client.synchronise_async(client.initialise())
         logging.info("Initialising channels")
+        start_time = time.monotonic()
         channels = self.get_channels(client, database)
         workshops = self.get_workshops(client, database)
-        pipe = Pipeline(database, client, channels, workshops, self.api_keys)
-        logging.info("Initialised channels")
+        pipe = Pipeline(
+            database,
+            client,
+            channels,
+            workshops,
+            self.api_keys,
+            self.worker_pool_sizes,
+            concurrency_limits=self.concurrency_limits,
+            ffmpeg_memory_limit=self.ffmpeg_memory_limit_mb * 1024 * 1024 if self.ffmpeg_memory_limit_mb else None,
+            task_timeouts=self.task_timeouts
+        )
+        download_stats = client.media_downloader.total_stats
+        logging.info(
+            f"Initialised channels in {time.monotonic() - start_time:.1f} seconds, "
+            f"downloading {download_stats.files} files ({download_stats.megabytes:.1f} MB)"
+        )
         return pipe
 
     def get_channels(self, client: TelegramClient, database: Database) -> List[Channel]:
@@ -67,9 +114,11 @@ class PipelineConfig:
                 None
             )
             if matching_db_chat:
-                channel_inits.append(Channel.from_data(matching_db_chat, conf, client, database))
+                channel_inits.append(
+                    Channel.from_data(matching_db_chat, conf, client, database, full_sync=self.full_sync)
+                )
             else:
-                channel_inits.append(Channel.from_config(conf, client, database))
+                channel_inits.append(Channel.from_config(conf, client, database, full_sync=self.full_sync))
         channels = client.synchronise_async(asyncio.gather(*channel_inits))
         return channels
 
@@ -82,9 +131,11 @@ class PipelineConfig:
                 None
             )
             if matching_db_chat:
-                workshop_inits.append(WorkshopGroup.from_data(matching_db_chat, conf, client, database))
+                workshop_inits.append(
+                    WorkshopGroup.from_data(matching_db_chat, conf, client, database, full_sync=self.full_sync)
+                )
             else:
-                workshop_inits.append(WorkshopGroup.from_config(conf, client, database))
+                workshop_inits.append(WorkshopGroup.from_config(conf, client, database, full_sync=self.full_sync))
         channels = client.synchronise_async(asyncio.gather(*workshop_inits))
         return channels
 
@@ -96,37 +147,54 @@ class Pipeline:
             client: TelegramClient,
             channels: List[Channel],
             workshops: List[WorkshopGroup],
-            api_keys: Dict[str, Dict[str, str]]
+            api_keys: Dict[str, Dict[str, str]],
+            worker_pool_sizes: Optional[Dict[ResourceClass, int]] = None,
+            *,
+            concurrency_limits: Optional[Tuple[int, int]] = None,
+            ffmpeg_memory_limit: Optional[int] = None,
+            task_timeouts: Optional[Dict[ResourceClass, Optional[float]]] = None
     ):
         self.database = database
         self.channels = channels
         self.workshops = workshops
         self.client = client
         self.api_keys = api_keys
-        self.worker = TaskWorker(3)
+        self.worker = TaskWorker(
+            worker_pool_sizes, ffmpeg_memory_limit=ffmpeg_memory_limit, timeouts=task_timeouts
+        )
+        self.concurrency_governor: Optional[ConcurrencyGovernor] = None
+        if concurrency_limits is not None:
+            floor, ceiling = concurrency_limits
+            cpu_bound_pools = {
+                resource_class: pool for resource_class, pool in self.worker.pools.items()
+                if resource_class in TaskWorker.CPU_BOUND
+            }
+            self.concurrency_governor = ConcurrencyGovernor(cpu_bound_pools, floor, ceiling)
+        logging.info("Task worker pool sizes: " + ", ".join(
+            f"{resource_class.value}: {pool.num_concurrent}" for resource_class, pool in self.worker.pools.items()
+        ))
         self.helpers = {}
         self.menu_cache = MenuCache()
+        self.hash_backfill: Optional[asyncio.Task] = None
+        self.concurrency_governor_task: Optional[asyncio.Task] = None
+        self._chats_by_id: Dict[int, Group] = {}
+        for chat in self.channels + self.workshops:
+            self._chats_by_id[chat.chat_data.chat_id] = chat
 
     @property
     def all_chats(self) -> List[Group]:
-        channels = [x for x in self.channels]  # type: List[Group]
-        for workshop in self.workshops:
-            channels.append(workshop)
-        return channels
+        return list(self._chats_by_id.values())
 
     @property
-    def all_chat_ids(self) -> List[int]:
-        return [chat.chat_data.chat_id for chat in self.all_chats]
+    def all_chat_ids(self) -> KeysView[int]:
+        return self._chats_by_id.keys()
 
     def chat_by_id(self, chat_id: int) -> Optional[Group]:
-        for chat in self.all_chats:
-            if chat.chat_data.chat_id == chat_id:
-                return chat
-        return None
+        return self._chats_by_id.get(chat_id)
 
     def initialise_helpers(self) -> None:
         logging.info("Initialising helpers")
-        duplicate_helper = self.client.synchronise_async(self.initialise_duplicate_detector())
+        duplicate_helper = self.initialise_duplicate_detector()
         menu_helper = MenuHelper(self.database, self.client, self.worker, self.menu_cache)
         helpers = [
             duplicate_helper,
@@ -155,10 +223,12 @@ class Pipeline:
             self.helpers[helper.name] = helper
         logging.info(f"Initialised {len(self.helpers)} helpers")
 
-    async def initialise_duplicate_detector(self) -> DuplicateHelper:
-        helper = DuplicateHelper(self.database, self.client, self.worker)
+    def initialise_duplicate_detector(self) -> DuplicateHelper:
+        helper = DuplicateHelper(self.database, self.client, self.worker, self.channels)
         logging.info("Initialising DuplicateHelper")
-        await helper.initialise_hashes(self.workshops)
+        helper.initialise_hashes()
+        # Hash any videos missing hashes in the background, so that other helpers can start straight away
+        self.hash_backfill = self.client.client.loop.create_task(helper.backfill_hashes(self.workshops))
         logging.info("Initialised DuplicateHelper")
         return helper
 
@@ -168,7 +238,14 @@ class Pipeline:
         self.client.add_edit_handler(self.on_edit_message, self.all_chat_ids)
         self.client.add_delete_handler(self.on_deleted_message)
         self.client.add_callback_query_handler(self.on_callback_query)
-        self.client.client.run_until_disconnected()
+        if self.concurrency_governor is not None:
+            self.concurrency_governor_task = self.client.client.loop.create_task(self.concurrency_governor.run())
+        # Exit cleanly on SIGTERM as well as Ctrl-C, so that ffmpeg processes in their own process groups are stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.client.client.run_until_disconnected()
+        finally:
+            kill_all_process_groups()
 
     async def on_edit_message(self, event: events.MessageEdited.Event):
         # Get chat, check it's one we know
@@ -200,17 +277,27 @@ class Pipeline:
         self.database.save_message(new_message.message_data)
         logging.info(f"New message initialised: {new_message}")
         # Pass to helpers
-        await self.pass_message_to_handlers(new_message, chat)
+        await self.pass_message_to_handlers(new_message, chat, is_command=True)
 
-    async def pass_message_to_handlers(self, new_message: Message, chat: Group = None):
+    async def pass_message_to_handlers(self, new_message: Message, chat: Group = None, *, is_command: bool = False):
         if chat is None:
             chat = self.chat_by_id(new_message.chat_data.chat_id)
-        helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
-            *(helper.on_new_message(chat, new_message) for helper in self.helpers.values()),
-            return_exceptions=True
-        )
+        # Work done for a message is dropped if it is deleted. A message from a user may be a command acting on the
+        # message it replies to, so its work is dropped if that is deleted too. The bot's own replies to a command are
+        # not commands, and their work should not be dropped because the command was deleted
+        message_data = new_message.message_data
+        owners = [(message_data.chat_id, message_data.message_id)]
+        if is_command and message_data.reply_to is not None:
+            owners.append((message_data.chat_id, message_data.reply_to))
+        with task_owners(*owners):
+            helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
+                *(helper.on_new_message(chat, new_message) for helper in self.helpers.values()),
+                return_exceptions=True
+            )
         for helper, result in zip(self.helpers.keys(), helper_results):
-            if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                logging.info(f"Helper {helper} stopped handling message {new_message}, as it was deleted")
+            elif isinstance(result, BaseException):
                 logging.error(
                     f"Helper {helper} threw an exception trying to handle message {new_message}.",
                     exc_info=result
@@ -223,6 +310,13 @@ class Pipeline:
         # Get messages
         chat = self.chat_by_id(event.chat_id)
         messages = self.get_messages_for_delete_event(event)
+        # Stop any work still being done for the deleted messages, before removing them
+        for message in messages:
+            num_cancelled = self.worker.cancel_message_tasks(
+                message.chat_data.chat_id, [message.message_data.message_id]
+            )
+            if num_cancelled:
+                logging.info(f"Cancelled {num_cancelled} tasks in progress for deleted message {message}")
         for message in messages:
             # Tell helpers
             helper_results = await asyncio.gather(
@@ -247,13 +341,12 @@ class Pipeline:
             return [
                 message
                 for workshop in self.workshops
-                for message in workshop.messages
-                if message.message_data.message_id in deleted_ids
+                for message in workshop.messages_by_ids(deleted_ids)
             ]
         chat = self.chat_by_id(event.chat_id)
         if chat is None:
             return []
-        return [message for message in chat.messages if message.message_data.message_id in deleted_ids]
+        return chat.messages_by_ids(deleted_ids)
 
     async def on_callback_query(self, event: events.CallbackQuery.Event):
         # Get chat, check it's one we know
@@ -278,14 +371,24 @@ class Pipeline:
             logging.info("Callback received for a menu which has already been clicked")
             await event.answer("That menu has already been clicked.")
             return
-        # Hand callback queries to helpers
-        helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
-            *(helper.on_callback_query(event.data, menu) for helper in self.helpers.values()),
-            return_exceptions=True
-        )
+        # Hand callback queries to helpers, dropping the work if the command or its video is deleted. Not the menu
+        # itself, as menus delete themselves when clicked, and that must not cancel the work they started
+        menu_owners = [
+            (menu.menu.cmd.chat_data.chat_id, menu.menu.cmd.message_data.message_id),
+            (menu.menu.video.chat_data.chat_id, menu.menu.video.message_data.message_id)
+        ]
+        with task_owners(*menu_owners):
+            helper_results: Iterable[Union[BaseException, Optional[List[Message]]]] = await asyncio.gather(
+                *(helper.on_callback_query(event.data, menu) for helper in self.helpers.values()),
+                return_exceptions=True
+            )
         answered = False
         for helper, result in zip(self.helpers.keys(), helper_results):
-            if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                logging.info(
+                    f"Helper {helper} stopped handling callback query {event}, as its command or video was deleted"
+                )
+            elif isinstance(result, BaseException):
                 logging.error(
                     f"Helper {helper} threw an exception trying to handle callback query {event}.",
                     exc_info=result
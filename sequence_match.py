@@ -0,0 +1,141 @@
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Tuple
+
+import numpy
+
+from hash_index import HashIndex
+
+
+@dataclass
+class FrameSequence:
+    """
+    The frame hashes of a video in the order they were sampled, with the time in seconds each frame was shown
+    """
+    hashes: List[int]
+    frame_times: List[float]
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def hashes_to_bytes(self) -> bytes:
+        return numpy.array(self.hashes, dtype="<u8").tobytes()
+
+    def frame_times_to_bytes(self) -> bytes:
+        return numpy.array(self.frame_times, dtype="<f4").tobytes()
+
+    @classmethod
+    def from_bytes(cls, hashes: bytes, frame_times: bytes) -> "FrameSequence":
+        return cls(
+            [int(image_hash) for image_hash in numpy.frombuffer(hashes, dtype="<u8")],
+            [float(frame_time) for frame_time in numpy.frombuffer(frame_times, dtype="<f4")]
+        )
+
+
+@dataclass
+class SequenceMatch:
+    """
+    An aligned stretch of two videos, with the matching time range in each, in seconds
+    """
+    query_start: float
+    query_end: float
+    match_start: float
+    match_end: float
+    matched_frames: int
+    # Fraction of frames within the matching range which have a matching frame at the same offset, counted in whichever
+    # of the two videos has fewer frames in that range
+    score: float
+
+    @property
+    def duration(self) -> float:
+        return self.query_end - self.query_start
+
+
+def matching_frame_pairs(
+        query_hashes: List[int],
+        candidate_hashes: List[int],
+        max_distance: int,
+        ignore_hashes: frozenset = frozenset()
+) -> List[Tuple[int, int]]:
+    """
+    Lists every pair of frames whose hashes match, as (query index, candidate index), ordered by query index.
+    Each distinct query hash is looked up in an index of the candidate's hashes, rather than compared against all of
+    them, so long videos with few matching frames are cheap to compare.
+    """
+    candidate_indexes: Dict[int, List[int]] = defaultdict(list)
+    for candidate_index, image_hash in enumerate(candidate_hashes):
+        candidate_indexes[image_hash].append(candidate_index)
+    hash_index = HashIndex()
+    hash_index.add_all(candidate_indexes.keys())
+    matches_by_hash: Dict[int, List[int]] = {}
+    pairs = []
+    for query_index, image_hash in enumerate(query_hashes):
+        if image_hash in ignore_hashes:
+            continue
+        if image_hash not in matches_by_hash:
+            matches_by_hash[image_hash] = sorted(
+                candidate_index
+                for matching_hash in hash_index.find_within(image_hash, max_distance)
+                for candidate_index in candidate_indexes[matching_hash]
+            )
+        pairs.extend((query_index, candidate_index) for candidate_index in matches_by_hash[image_hash])
+    return pairs
+
+
+def align_sequences(
+        query: FrameSequence,
+        candidate: FrameSequence,
+        max_distance: int,
+        *,
+        ignore_hashes: frozenset = frozenset(),
+        offset_tolerance: float = 0.5
+) -> Optional[SequenceMatch]:
+    """
+    Finds the time offset at which the most frames of the query video match frames of the candidate video, and
+    describes the overlap at that offset. Matching frames which do not line up with the rest, such as a shared blank
+    or title frame, are not counted.
+    :param query: The new video's frame sequence
+    :param candidate: A stored video's frame sequence
+    :param max_distance: The maximum number of differing bits for two frame hashes to match
+    :param ignore_hashes: Hashes which should never count as matching, such as a blank frame
+    :param offset_tolerance: How far apart, in seconds, two matching frame pairs' offsets can be, to count as aligned
+    :return: The best alignment, or None if no frames match
+    """
+    if not query.hashes or not candidate.hashes:
+        return None
+    pairs = matching_frame_pairs(query.hashes, candidate.hashes, max_distance, ignore_hashes)
+    if not pairs:
+        return None
+    # Vote on the offset between the two videos, in bins the width of the tolerance
+    offset_bins = Counter(
+        round((candidate.frame_times[candidate_index] - query.frame_times[query_index]) / offset_tolerance)
+        for query_index, candidate_index in pairs
+    )
+    best_bin, _ = offset_bins.most_common(1)[0]
+    aligned = [
+        (query_index, candidate_index) for query_index, candidate_index in pairs
+        if abs(
+            candidate.frame_times[candidate_index] - query.frame_times[query_index] - best_bin * offset_tolerance
+        ) <= offset_tolerance
+    ]
+    matched_query_indexes = sorted({query_index for query_index, _ in aligned})
+    matched_candidate_indexes = {candidate_index for _, candidate_index in aligned}
+    matched_candidate_times = [candidate.frame_times[candidate_index] for candidate_index in matched_candidate_indexes]
+    first_index, last_index = matched_query_indexes[0], matched_query_indexes[-1]
+    match_start, match_end = min(matched_candidate_times), max(matched_candidate_times)
+    # Score against every frame of the sparser sequence in the matching range, so unmatched frames in the middle lower
+    # the score, but a video sampled less often, such as only at keyframes, is not penalised for having fewer frames
+    query_frames_in_range = last_index - first_index + 1
+    candidate_frames_in_range = sum(match_start <= frame_time <= match_end for frame_time in candidate.frame_times)
+    if candidate_frames_in_range < query_frames_in_range:
+        score = len(matched_candidate_indexes) / candidate_frames_in_range
+    else:
+        score = len(matched_query_indexes) / query_frames_in_range
+    return SequenceMatch(
+        query.frame_times[first_index],
+        query.frame_times[last_index],
+        match_start,
+        match_end,
+        len(matched_query_indexes),
+        score
+    )
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+from typing import Optional, Dict
+
+from tasks.task import ResourceClass
+from tasks.task_worker import TaskPool
+
+
+def load_per_cpu() -> Optional[float]:
+    """The 1 minute load average per core, or None where load averages are not available, such as on Windows"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def free_memory_fraction() -> Optional[float]:
+    """The fraction of memory available to new processes, or None where /proc/meminfo is not available"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) for line in f if len(line.split()) >= 2}
+    except (OSError, ValueError):
+        return None
+    if "MemAvailable" not in meminfo or not meminfo.get("MemTotal"):
+        return None
+    return meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+
+class ConcurrencyGovernor:
+    """
+    Periodically raises or lowers how many tasks each pool runs at once, within a floor and ceiling.
+    A pool is scaled down whenever the machine is overloaded, or out of memory. It is scaled up one step at a time
+    while it has queued tasks and the machine has capacity to spare, and if the step does not raise the rate of tasks
+    completed, it is reverted and held for a while.
+    Completion rates are measured over a window several times as long as the pool's average task, so that pools of
+    long tasks, such as encodes, are judged on enough completed tasks to tell a real change from noise.
+    """
+    # Load per core above which pools are scaled down, and below which they may be scaled up
+    MAX_LOAD = 1.0
+    SCALE_UP_LOAD = 0.75
+    # Fraction of memory which must stay available
+    MIN_FREE_MEMORY = 0.1
+    # Number of measurement windows to wait before trying to scale a pool up again, after scaling it up did not help
+    HOLD_WINDOWS = 6
+    # Length of a pool's measurement window, in multiples of its average task duration
+    WINDOW_TASK_DURATIONS = 3
+    # Fraction of one task's share of the completion rate which an extra task at once must add, to be kept
+    MIN_SCALE_UP_GAIN = 0.5
+
+    def __init__(self, pools: Dict[ResourceClass, TaskPool], floor: int, ceiling: int, interval: float = 10):
+        self.pools = pools
+        # Pools never go below their minimum size, so neither should the floor, or scaling down would never settle
+        self.floor = max(floor, TaskPool.MIN_CONCURRENT)
+        self.ceiling = max(ceiling, self.floor)
+        self.interval = interval
+        self._window_start_completed = {resource_class: pool.num_completed for resource_class, pool in pools.items()}
+        self._window_elapsed = {resource_class: 0.0 for resource_class in pools}
+        # Completion rate in the window before a pool was scaled up, for pools which were scaled up last window
+        self._rate_before_scale_up: Dict[ResourceClass, float] = {}
+        self._hold = {resource_class: 0 for resource_class in pools}
+        for pool in pools.values():
+            pool.set_num_concurrent(min(max(pool.num_concurrent, self.floor), self.ceiling))
+
+    def window_length(self, resource_class: ResourceClass) -> float:
+        """Seconds to measure a pool's completion rate over, before deciding whether to scale it up"""
+        average_duration = self.pools[resource_class].average_duration or 0
+        return max(self.interval, self.WINDOW_TASK_DURATIONS * average_duration)
+
+    def target_concurrency(
+            self,
+            resource_class: ResourceClass,
+            completion_rate: float,
+            load: Optional[float]
+    ) -> int:
+        """
+        Decides on a pool's concurrency at the end of a measurement window
+        :param completion_rate: Tasks completed per second over the window
+        """
+        pool = self.pools[resource_class]
+        current = pool.num_concurrent
+        rate_before_scale_up = self._rate_before_scale_up.pop(resource_class, None)
+        if self._hold[resource_class] > 0:
+            self._hold[resource_class] -= 1
+        if rate_before_scale_up is not None and pool.num_waiting > 0 and completion_rate < (
+                rate_before_scale_up * (1 + self.MIN_SCALE_UP_GAIN / (current - 1))
+        ):
+            # The extra task at once did not get enough more done, so go back to what it was
+            self._hold[resource_class] = self.HOLD_WINDOWS
+            return current - 1
+        if pool.num_waiting > 0 and self._hold[resource_class] == 0 and (load is None or load < self.SCALE_UP_LOAD):
+            self._rate_before_scale_up[resource_class] = completion_rate
+            return current + 1
+        return current
+
+    def _start_window(self, resource_class: ResourceClass) -> None:
+        self._window_start_completed[resource_class] = self.pools[resource_class].num_completed
+        self._window_elapsed[resource_class] = 0.0
+
+    def adjust(self) -> None:
+        load = load_per_cpu()
+        free_memory = free_memory_fraction()
+        overloaded = load is not None and load > self.MAX_LOAD
+        out_of_memory = free_memory is not None and free_memory < self.MIN_FREE_MEMORY
+        for resource_class, pool in self.pools.items():
+            self._window_elapsed[resource_class] += self.interval
+            completed = pool.num_completed - self._window_start_completed[resource_class]
+            elapsed = self._window_elapsed[resource_class]
+            if overloaded or out_of_memory:
+                # Scaling down cannot wait for the window to end, and the next window measures the new concurrency
+                target = pool.num_concurrent - 1
+                self._rate_before_scale_up.pop(resource_class, None)
+                self._start_window(resource_class)
+            elif elapsed < self.window_length(resource_class):
+                continue
+            else:
+                target = self.target_concurrency(resource_class, completed / elapsed, load)
+                self._start_window(resource_class)
+            target = min(max(target, self.floor), self.ceiling)
+            if target <= pool.num_concurrent:
+                # Not scaled up after all, so there is nothing to compare next time
+                self._rate_before_scale_up.pop(resource_class, None)
+            if target != pool.num_concurrent:
+                logging.info(
+                    f"Changing {resource_class.value} task concurrency from {pool.num_concurrent} to {target}, "
+                    f"with load per core {load}, free memory fraction {free_memory}, "
+                    f"and {completed} tasks completed in the last {elapsed:.0f} seconds"
+                )
+                pool.set_num_concurrent(target)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.adjust()
+            except Exception as e:
+                logging.warning("Failed to adjust task concurrency", exc_info=e)
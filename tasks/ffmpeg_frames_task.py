@@ -0,0 +1,94 @@
+import asyncio
+import inspect
+import re
+import subprocess
+from typing import Callable, Optional, Awaitable
+
+import ffmpy3
+
+from tasks.ffmpeg_task import with_thread_limit
+from tasks.process_group import start_process, kill_process_group
+from tasks.process_limits import limit_process_memory
+from tasks.task import Task, ResourceClass
+
+# The showinfo filter logs a line like this for each frame passing through it
+SHOWINFO_FRAME_TIME = re.compile(r"\[Parsed_showinfo_\d+ @ \w+] n:\s*\d+ .*?\bpts_time:(-?[\d.]+)")
+
+
+class FfmpegFramesTask(Task[int]):
+    """
+    Runs ffmpeg with raw video written to stdout, passing each frame to a callback as soon as it has been read.
+    If the callback returns an awaitable, it is awaited before the next frame is read.
+    If on_frame_time is given, the output options must include a showinfo filter, and the time of each frame it logs
+    is passed to that callback, in the same order as the frames.
+    Returns the number of frames read.
+    """
+    resource_class = ResourceClass.ANALYSIS
+
+    def __init__(
+            self,
+            frame_size: int,
+            on_frame: Callable[[bytes], Optional[Awaitable[None]]],
+            *,
+            on_frame_time: Optional[Callable[[float], None]] = None,
+            global_options=None,
+            inputs=None,
+            output_options=None
+    ):
+        self.frame_size = frame_size
+        self.on_frame = on_frame
+        self.on_frame_time = on_frame_time
+        self.global_options = global_options
+        self.inputs = inputs
+        self.output_options = output_options
+
+    async def run(self) -> int:
+        ff = ffmpy3.FFmpeg(
+            global_options=self.global_options,
+            inputs={path: with_thread_limit(options, self.num_threads) for path, options in self.inputs.items()},
+            outputs={"pipe:1": self.output_options}
+        )
+        stderr = subprocess.DEVNULL if self.on_frame_time is None else subprocess.PIPE
+        ff_process = await start_process(ff, stdout=subprocess.PIPE, stderr=stderr)
+        limit_process_memory(ff_process.pid, self.memory_limit)
+        # Both pipes are read at once, so that ffmpeg never blocks on a full stderr pipe
+        readers = [self._read_frames(ff_process.stdout)]
+        if self.on_frame_time is not None:
+            readers.append(self._read_frame_times(ff_process.stderr))
+        try:
+            num_frames, *_ = await asyncio.gather(*readers)
+            await ff.wait()
+        except asyncio.CancelledError:
+            await kill_process_group(ff_process)
+            raise
+        return num_frames
+
+    async def _read_frames(self, stream: asyncio.StreamReader) -> int:
+        num_frames = 0
+        while True:
+            try:
+                frame = await stream.readexactly(self.frame_size)
+            except asyncio.IncompleteReadError:
+                break
+            result = self.on_frame(frame)
+            if inspect.isawaitable(result):
+                await result
+            num_frames += 1
+        return num_frames
+
+    async def _read_frame_times(self, stream: asyncio.StreamReader) -> None:
+        # ffmpeg ends progress lines with carriage returns, so split on either line ending
+        buffer = b""
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            *lines, buffer = re.split(rb"[\r\n]", buffer + chunk)
+            for line in lines:
+                self._read_frame_time(line)
+        self._read_frame_time(buffer)
+
+    def _read_frame_time(self, line: bytes) -> None:
+        match = SHOWINFO_FRAME_TIME.search(line.decode("utf-8", "replace"))
+        if match is not None:
+            self.on_frame_time(float(match.group(1)))
@@ -1,11 +1,60 @@
+import asyncio
+import os
+import shutil
 import subprocess
-from typing import Tuple
+from typing import Tuple, Optional, Hashable, Dict, List
 
 import ffmpy3
 
+from tasks.process_group import start_process, kill_process_group, remove_partial_outputs
+from tasks.process_limits import limit_process_memory
 from tasks.task import Task
 
 
+def with_thread_limit(options, num_threads: Optional[int]):
+    """Adds a -threads option to the options for an ffmpeg input or output"""
+    if num_threads is None:
+        return options
+    if options is None:
+        return f"-threads {num_threads}"
+    if isinstance(options, str):
+        return f"-threads {num_threads} {options}"
+    return ["-threads", str(num_threads), *options]
+
+
+def input_identity(path: str) -> Hashable:
+    """
+    Identifies an input file by its inode, size, and modification time, so that the same file reached by different
+    paths has the same identity, and a file which has been rewritten does not. Inputs which are not files, such as
+    urls or lavfi sources, are identified by the input itself.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return path
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def is_output_file(path: str) -> bool:
+    """Whether an ffmpeg output is a file which the task creates, rather than a pipe or device"""
+    return path != os.devnull and path != "-" and not path.startswith("pipe:")
+
+
+def ffmpeg_command_key(executable: str, global_options, inputs: Dict, outputs: Dict) -> Hashable:
+    """
+    Canonical key for an ffmpeg or ffprobe command, for telling whether two tasks would do exactly the same work.
+    Input files are keyed by their identity rather than their path, and output files by their position and extension,
+    as each task writes to its own new file.
+    """
+    placeholder_inputs = {f"input{index}": options for index, options in enumerate(inputs.values())}
+    placeholder_outputs = {
+        f"output{index}{os.path.splitext(path)[1]}" if is_output_file(path) else path: options
+        for index, (path, options) in enumerate(outputs.items())
+    }
+    ff = ffmpy3.FFmpeg(executable, global_options, placeholder_inputs, placeholder_outputs)
+    return tuple(ff._cmd), tuple(input_identity(path) for path in inputs)
+
+
 class FfmpegTask(Task[Tuple[str, str]]):
 
     def __init__(self, *, global_options=None, inputs=None, outputs=None):
@@ -13,15 +62,44 @@ class FfmpegTask(Task[Tuple[str, str]]):
         self.inputs = inputs
         self.outputs = outputs
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        return ffmpeg_command_key("ffmpeg", self.global_options, self.inputs, self.outputs)
+
+    def take_shared_result(self, runner: 'FfmpegTask', result: Tuple[str, str]) -> Tuple[str, str]:
+        # The runner wrote the outputs, so put them at this task's output paths too
+        for path, runner_path in zip(self.outputs, runner.outputs):
+            if path == runner_path or not is_output_file(path) or not os.path.isfile(runner_path):
+                continue
+            if os.path.lexists(path):
+                os.remove(path)
+            try:
+                os.link(runner_path, path)
+            except OSError:
+                shutil.copyfile(runner_path, path)
+        return result
+
+    def discard_result(self, result: Tuple[str, str], sharers: List['FfmpegTask']) -> None:
+        # Sharers writing to the same path as this task still need the file
+        shared_paths = {path for sharer in sharers for path in sharer.outputs}
+        remove_partial_outputs(path for path in self.outputs if path not in shared_paths)
+
     async def run(self):
+        # Limit both decoding and encoding threads, so that concurrent tasks do not oversubscribe the cores
         ff = ffmpy3.FFmpeg(
             global_options=self.global_options,
-            inputs=self.inputs,
-            outputs=self.outputs
+            inputs={path: with_thread_limit(options, self.num_threads) for path, options in self.inputs.items()},
+            outputs={path: with_thread_limit(options, self.num_threads) for path, options in self.outputs.items()}
         )
-        ff_process = await ff.run_async(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ff_out = await ff_process.communicate()
-        await ff.wait()
+        ff_process = await start_process(ff, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        limit_process_memory(ff_process.pid, self.memory_limit)
+        try:
+            ff_out = await ff_process.communicate()
+            await ff.wait()
+        except asyncio.CancelledError:
+            # Cancelled or timed out, so stop the encode, and do not leave a broken output file behind
+            await kill_process_group(ff_process)
+            remove_partial_outputs(self.outputs.keys())
+            raise
         output = ff_out[0].decode('utf-8').strip()
         error = ff_out[1].decode('utf-8').strip()
         return output, error
@@ -1,24 +1,36 @@
+import asyncio
 import subprocess
+from typing import Optional, Hashable
 
 import ffmpy3
 
-from tasks.task import Task
+from tasks.ffmpeg_task import ffmpeg_command_key
+from tasks.process_group import start_process, kill_process_group
+from tasks.task import Task, ResourceClass
 
 
 class FFprobeTask(Task[str]):
+    resource_class = ResourceClass.PROBE
 
     def __init__(self, *, global_options=None, inputs=None, outputs=None):
         self.global_options = global_options
         self.inputs = inputs
         self.outputs = outputs
 
+    def coalesce_key(self) -> Optional[Hashable]:
+        return ffmpeg_command_key("ffprobe", self.global_options, self.inputs, {})
+
     async def run(self) -> str:
         ffprobe = ffmpy3.FFprobe(
             global_options=self.global_options,
             inputs=self.inputs
         )
-        ffprobe_process = await ffprobe.run_async(stdout=subprocess.PIPE)
-        ffprobe_out = await ffprobe_process.communicate()
-        await ffprobe.wait()
+        ffprobe_process = await start_process(ffprobe, stdout=subprocess.PIPE)
+        try:
+            ffprobe_out = await ffprobe_process.communicate()
+            await ffprobe.wait()
+        except asyncio.CancelledError:
+            await kill_process_group(ffprobe_process)
+            raise
         output = ffprobe_out[0].decode('utf-8').strip()
         return output
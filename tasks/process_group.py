@@ -0,0 +1,78 @@
+import asyncio
+import atexit
+import logging
+import os
+import signal
+import subprocess
+from typing import Union, Iterable, Set
+
+import ffmpy3
+
+if os.name == "posix":
+    # Each process starts its own session, and so its own process group, which can be killed as a whole
+    _NEW_PROCESS_GROUP = {"start_new_session": True}
+else:
+    _NEW_PROCESS_GROUP = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+
+# Processes started by start_process() which may still be running. Being in their own process groups, they do not get
+# the signals which stop the bot, so they are killed when it exits instead
+_live_processes: Set[asyncio.subprocess.Process] = set()
+
+
+async def start_process(
+        ff: Union[ffmpy3.FFmpeg, ffmpy3.FFprobe],
+        stdout=None,
+        stderr=None
+) -> asyncio.subprocess.Process:
+    """
+    Starts an ffmpeg or ffprobe command like ff.run_async(), but in a new process group, so that cancelling it can
+    kill the process along with anything it started. ff.wait() still waits for it, as it would after run_async().
+    """
+    try:
+        ff.process = await asyncio.create_subprocess_exec(
+            *ff._cmd, stdout=stdout, stderr=stderr, **_NEW_PROCESS_GROUP
+        )
+    except FileNotFoundError as e:
+        raise ffmpy3.FFExecutableNotFoundError(f"Executable '{ff.executable}' not found") from e
+    _live_processes.difference_update([process for process in _live_processes if process.returncode is not None])
+    _live_processes.add(ff.process)
+    return ff.process
+
+
+def _kill_process_group(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        # Already exited
+        pass
+
+
+async def kill_process_group(process: asyncio.subprocess.Process) -> None:
+    """Kills a process started by start_process(), along with the rest of its process group, and waits for it to exit"""
+    _kill_process_group(process)
+    await process.wait()
+    _live_processes.discard(process)
+
+
+@atexit.register
+def kill_all_process_groups() -> None:
+    """Kills every process started by start_process() which is still running, so that none outlive the bot"""
+    for process in list(_live_processes):
+        _kill_process_group(process)
+    _live_processes.clear()
+
+
+def remove_partial_outputs(paths: Iterable[str]) -> None:
+    """Deletes output files left half written by a killed process. Pipes and devices are left alone."""
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Failed to remove partial output {path}", exc_info=e)
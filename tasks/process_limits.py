@@ -0,0 +1,25 @@
+import logging
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def limit_process_memory(pid: int, limit_bytes: Optional[int]) -> None:
+    """
+    Limits the address space of a running process, so that it fails to allocate memory past the limit, rather than
+    pushing the whole machine out of memory. Only supported on Linux, elsewhere this does nothing.
+    """
+    if limit_bytes is None:
+        return
+    if resource is None or not hasattr(resource, "prlimit"):
+        logging.debug("Process memory limits are not supported on this platform")
+        return
+    try:
+        resource.prlimit(pid, resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    except ProcessLookupError:
+        # The process has already finished
+        pass
@@ -1,11 +1,51 @@
 from abc import ABC, abstractmethod
-from typing import TypeVar, Generic
+from enum import Enum
+from typing import TypeVar, Generic, Optional, Hashable, List
 
 T = TypeVar('T')
 
 
+class ResourceClass(Enum):
+    # CPU heavy ffmpeg runs, which write a new video
+    ENCODE = "encode"
+    # Quick ffprobe calls
+    PROBE = "probe"
+    # Downloads, which mostly wait on the network
+    NETWORK = "network"
+    # Decoding videos to analyse them, such as hashing frames
+    ANALYSIS = "analysis"
+
+
 class Task(ABC, Generic[T]):
+    # The pool of the task worker which this task runs in
+    resource_class = ResourceClass.ENCODE
+    # Number of threads the task may use, set by the task worker for its pool, or None for no limit
+    num_threads: Optional[int] = None
+    # Maximum bytes of memory any process the task runs may use, set by the task worker, or None for no limit
+    memory_limit: Optional[int] = None
+    # Seconds the task may run for before it is cancelled, set by the task worker for its pool, or None for no limit
+    timeout: Optional[float] = None
 
     @abstractmethod
     async def run(self) -> T:
         pass
+
+    def coalesce_key(self) -> Optional[Hashable]:
+        """
+        A key describing exactly what the task does, so that tasks with equal keys running at the same time can share
+        one run and its result, or None if the task must always run itself
+        """
+        return None
+
+    def take_shared_result(self, runner: 'Task[T]', result: T) -> T:
+        """
+        Gives this task the result of an identical task which ran in its place, such as by copying output files
+        """
+        return result
+
+    def discard_result(self, result: T, sharers: List['Task[T]']) -> None:
+        """
+        Cleans up the result of a run which this task's own caller stopped waiting for, such as by deleting output
+        files, once the tasks which shared the run have taken their results
+        """
+        pass
@@ -1,18 +1,353 @@
 import asyncio
-from typing import List
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import List, Dict, Deque, Optional, Iterator, Tuple, FrozenSet, Set, Iterable, Hashable, Any
 
-from tasks.task import Task, T
+from tasks.task import Task, T, ResourceClass
+
+
+class TaskPriority(IntEnum):
+    # A user is waiting on the result of a single command
+    INTERACTIVE = 0
+    # A user command which produces many tasks, such as splitting a video into scenes
+    USER_BULK = 1
+    # Work nobody is waiting on, such as backfilling hashes
+    BACKGROUND = 2
+
+
+# Priority of tasks awaited without one given, set for everything awaited inside a task_priority() block
+_current_priority: ContextVar[TaskPriority] = ContextVar("task_priority", default=TaskPriority.INTERACTIVE)
+
+
+@contextmanager
+def task_priority(priority: TaskPriority) -> Iterator[None]:
+    """
+    Sets the priority of all tasks awaited inside the block, including by coroutines it gathers
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+# A message which work is being done for, as its chat id and message id
+MessageKey = Tuple[int, int]
+# Messages which tasks awaited inside a task_owners() block are doing work for
+_current_owners: ContextVar[FrozenSet[MessageKey]] = ContextVar("task_owners", default=frozenset())
+
+
+@contextmanager
+def task_owners(*message_keys: MessageKey) -> Iterator[None]:
+    """
+    Ties all tasks awaited inside the block, including by coroutines it gathers, to the given messages, as well as
+    any the block is already tied to. Deleting any of those messages cancels the tasks, with
+    TaskWorker.cancel_message_tasks()
+    """
+    token = _current_owners.set(_current_owners.get() | frozenset(message_keys))
+    try:
+        yield
+    finally:
+        _current_owners.reset(token)
+
+
+def default_pool_sizes(num_cpus: int) -> Dict[ResourceClass, int]:
+    return {
+        # Encodes use several threads each, so run fewer of them than there are cores
+        ResourceClass.ENCODE: max(num_cpus // 2, TaskPool.MIN_CONCURRENT),
+        # Probes are short, and mostly wait on reading the file
+        ResourceClass.PROBE: max(num_cpus * 2, 4),
+        ResourceClass.NETWORK: 4,
+        ResourceClass.ANALYSIS: max(num_cpus // 2, TaskPool.MIN_CONCURRENT),
+    }
+
+
+# Seconds each task may run for, by resource class, before it is assumed to be stuck and is cancelled
+DEFAULT_TIMEOUTS = {
+    ResourceClass.ENCODE: 60 * 60,
+    ResourceClass.PROBE: 60,
+    ResourceClass.NETWORK: 30 * 60,
+    ResourceClass.ANALYSIS: 30 * 60,
+}
+
+
+class TaskPool:
+    """
+    Runs up to num_concurrent tasks at once. Queued tasks start in priority order, so interactive tasks never wait
+    behind queued bulk or background tasks. Background tasks are also kept out of one slot, so that a newly queued
+    interactive task does not have to wait for long running background tasks to finish.
+    """
+    # Pools run at least two tasks at once, so that there is always a slot which background tasks can use, as well as
+    # the one kept free of them
+    MIN_CONCURRENT = 2
+    # Weight of each newly completed task in the pool's average task duration
+    DURATION_SMOOTHING = 0.2
+
+    def __init__(
+            self,
+            num_concurrent: int,
+            num_cpus: Optional[int] = None,
+            memory_limit: Optional[int] = None,
+            timeout: Optional[float] = None
+    ):
+        self.num_concurrent = max(num_concurrent, self.MIN_CONCURRENT)
+        # Number of cores shared out between the threads of this pool's tasks, or None to not limit their threads
+        self.num_cpus = num_cpus
+        # Maximum bytes of memory each process run by a task in this pool may use
+        self.memory_limit = memory_limit
+        # Seconds each task in this pool may run for, once started, or None for no limit
+        self.timeout = timeout
+        # Number of tasks which have finished, for measuring throughput
+        self.num_completed = 0
+        # Smoothed number of seconds tasks take to run once started, or None until one has finished
+        self.average_duration: Optional[float] = None
+        self._running: Dict[TaskPriority, int] = {priority: 0 for priority in TaskPriority}
+        self._waiting: Dict[TaskPriority, Deque[asyncio.Future]] = {priority: deque() for priority in TaskPriority}
+
+    def queue_depth(self, priority: TaskPriority) -> int:
+        return len(self._waiting[priority])
+
+    @property
+    def queue_depths(self) -> Dict[TaskPriority, int]:
+        return {priority: self.queue_depth(priority) for priority in TaskPriority}
+
+    @property
+    def num_threads(self) -> Optional[int]:
+        """Number of threads each task starting now may use, so that the pool's tasks together use every core once"""
+        if self.num_cpus is None:
+            return None
+        return max(self.num_cpus // self.num_concurrent, 1)
+
+    @property
+    def num_running(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    def set_num_concurrent(self, num_concurrent: int) -> None:
+        # When lowered, running tasks carry on, but no more start until enough have finished
+        self.num_concurrent = max(num_concurrent, self.MIN_CONCURRENT)
+        self._start_waiting_tasks()
+
+    def _has_free_slot(self, priority: TaskPriority) -> bool:
+        if self.num_running >= self.num_concurrent:
+            return False
+        if priority == TaskPriority.BACKGROUND:
+            return self._running[priority] < self.num_concurrent - 1
+        return True
+
+    def _start_waiting_tasks(self) -> None:
+        for priority in TaskPriority:
+            waiting = self._waiting[priority]
+            while waiting and self._has_free_slot(priority):
+                self._running[priority] += 1
+                waiting.popleft().set_result(None)
+            if waiting:
+                # Lower priorities wait until this priority's queue is empty
+                return
+
+    async def _acquire(self, priority: TaskPriority) -> None:
+        queued_ahead = any(self._waiting[ahead] for ahead in TaskPriority if ahead <= priority)
+        if not queued_ahead and self._has_free_slot(priority):
+            self._running[priority] += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiting[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._waiting[priority].remove(waiter)
+            else:
+                # Cancelled just after being given a slot, so hand it on
+                self._release(priority)
+            raise
+
+    def _release(self, priority: TaskPriority) -> None:
+        self._running[priority] -= 1
+        self._start_waiting_tasks()
+
+    def _record_duration(self, duration: float) -> None:
+        if self.average_duration is None:
+            self.average_duration = duration
+        else:
+            self.average_duration += self.DURATION_SMOOTHING * (duration - self.average_duration)
+
+    async def await_task(self, task: Task[T], priority: TaskPriority) -> T:
+        await self._acquire(priority)
+        try:
+            if task.num_threads is None:
+                task.num_threads = self.num_threads
+            if task.memory_limit is None:
+                task.memory_limit = self.memory_limit
+            if task.timeout is None:
+                task.timeout = self.timeout
+            start_time = time.monotonic()
+            try:
+                # On timeout, the task is cancelled, so it can kill its process before the slot is freed
+                result = await asyncio.wait_for(task.run(), task.timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{type(task).__name__} timed out after {task.timeout} seconds")
+                raise
+            self._record_duration(time.monotonic() - start_time)
+            self.num_completed += 1
+            return result
+        finally:
+            self._release(priority)
+
+
+class SharedRun:
+    """
+    A single run of a task, whose result is shared by every identical task awaited while it is queued or running
+    """
+
+    def __init__(self, runner: Task, priority: TaskPriority):
+        self.runner = runner
+        self.priority = priority
+        # Tasks still waiting on the result, including the runner
+        self.tasks: List[Task] = [runner]
+        self.future: Optional[asyncio.Future] = None
 
 
 class TaskWorker:
+    """
+    Runs each task in the pool for its resource class, so that quick probes do not queue behind slow encodes, and
+    downloads do not hold up CPU bound work. Pools default to sizes based on the number of cores, and CPU bound pools
+    share the cores out between the threads of the tasks they are running at the time.
+    Tasks awaited inside a task_owners() block are tracked by message, so that deleting a message can cancel the work
+    being done for it.
+    A task awaited while an identical one, with the same coalesce key, is queued or running, shares that one's run and
+    result rather than taking another slot.
+    """
+
+    # Pools of CPU bound tasks, which run ffmpeg
+    CPU_BOUND = {ResourceClass.ENCODE, ResourceClass.ANALYSIS}
+
+    def __init__(
+            self,
+            pool_sizes: Optional[Dict[ResourceClass, int]] = None,
+            *,
+            ffmpeg_memory_limit: Optional[int] = None,
+            timeouts: Optional[Dict[ResourceClass, Optional[float]]] = None
+    ):
+        num_cpus = os.cpu_count() or 1
+        pool_sizes = {**default_pool_sizes(num_cpus), **(pool_sizes or {})}
+        timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.pools = {
+            resource_class: TaskPool(
+                pool_size,
+                num_cpus if resource_class in self.CPU_BOUND else None,
+                ffmpeg_memory_limit if resource_class in self.CPU_BOUND else None,
+                timeouts.get(resource_class)
+            )
+            for resource_class, pool_size in pool_sizes.items()
+        }
+        # The asyncio tasks currently awaiting a task, by each message they are doing work for
+        self._tasks_by_owner: Dict[MessageKey, Set[asyncio.Task]] = {}
+        self._shared_runs: Dict[Hashable, SharedRun] = {}
+        # Number of tasks which shared another task's run, rather than running themselves
+        self.num_coalesced = 0
+
+    @property
+    def queue_depths(self) -> Dict[TaskPriority, int]:
+        return {
+            priority: sum(pool.queue_depth(priority) for pool in self.pools.values())
+            for priority in TaskPriority
+        }
+
+    async def await_task(self, task: Task[T], priority: Optional[TaskPriority] = None) -> T:
+        if priority is None:
+            priority = _current_priority.get()
+        owners = _current_owners.get()
+        if not owners:
+            return await self._await_shared(task, priority)
+        awaiting = asyncio.current_task()
+        for owner in owners:
+            self._tasks_by_owner.setdefault(owner, set()).add(awaiting)
+        try:
+            return await self._await_shared(task, priority)
+        finally:
+            for owner in owners:
+                owned = self._tasks_by_owner.get(owner, set())
+                owned.discard(awaiting)
+                if not owned:
+                    self._tasks_by_owner.pop(owner, None)
+
+    async def _await_shared(self, task: Task[T], priority: TaskPriority) -> T:
+        pool = self.pools[task.resource_class]
+        key = task.coalesce_key()
+        if key is None:
+            return await pool.await_task(task, priority)
+        shared = self._shared_runs.get(key)
+        if shared is not None and shared.priority > priority:
+            # Sharing a less urgent run could leave this task queued behind others, so run it separately
+            return await pool.await_task(task, priority)
+        if shared is None:
+            shared = SharedRun(task, priority)
+            self._shared_runs[key] = shared
+            shared.future = asyncio.ensure_future(self._run_shared(key, shared, pool))
+        else:
+            shared.tasks.append(task)
+            self.num_coalesced += 1
+            logging.debug(f"{type(task).__name__} is sharing the run of an identical task already in progress")
+        try:
+            # Shielded, so that one task being cancelled does not cancel the run for the others sharing it
+            results = await asyncio.shield(shared.future)
+        except asyncio.CancelledError:
+            if not shared.future.done():
+                shared.tasks.remove(task)
+                if not shared.tasks:
+                    # Nothing is waiting on the run any more, so stop it
+                    self._forget_shared_run(key, shared)
+                    shared.future.cancel()
+            raise
+        result = results[task]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def _run_shared(self, key: Hashable, shared: SharedRun, pool: TaskPool) -> Dict[Task, Any]:
+        try:
+            result = await pool.await_task(shared.runner, shared.priority)
+        finally:
+            self._forget_shared_run(key, shared)
+        # Results are handed out before any waiting task resumes, as the runner's caller may delete its output files
+        results: Dict[Task, Any] = {}
+        for task in shared.tasks:
+            try:
+                results[task] = result if task is shared.runner else task.take_shared_result(shared.runner, result)
+            except Exception as e:
+                results[task] = e
+        if shared.runner not in shared.tasks:
+            # The runner's caller stopped waiting, so nothing will use or clean up its own output
+            shared.runner.discard_result(result, shared.tasks)
+        return results
 
-    def __init__(self, num_concurrent):
-        self.num_concurrent = num_concurrent
-        self.semaphore = asyncio.Semaphore(num_concurrent)
+    def _forget_shared_run(self, key: Hashable, shared: SharedRun) -> None:
+        if self._shared_runs.get(key) is shared:
+            del self._shared_runs[key]
 
-    async def await_task(self, task: Task[T]) -> T:
-        async with self.semaphore:
-            return await task.run()
+    def cancel_message_tasks(self, chat_id: int, message_ids: Iterable[int]) -> int:
+        """
+        Cancels the work being done for the given messages, whether their tasks are queued or running. Cancellation
+        reaches the coroutine which awaited each task, so it stops rather than carrying on with the next step.
+        :return: The number of coroutines cancelled
+        """
+        awaiting = {
+            owned_task
+            for message_id in message_ids
+            for owned_task in self._tasks_by_owner.get((chat_id, message_id), set())
+        }
+        for owned_task in awaiting:
+            owned_task.cancel()
+        return len(awaiting)
 
-    async def await_tasks(self, tasks: List[Task]):
-        return await asyncio.gather(*[self.await_task(task) for task in tasks])
+    async def await_tasks(self, tasks: List[Task], priority: Optional[TaskPriority] = None):
+        return await asyncio.gather(*[self.await_task(task, priority) for task in tasks])
@@ -1,11 +1,13 @@
+import asyncio
 import glob
 
 import youtube_dl
 
-from tasks.task import Task
+from tasks.task import Task, ResourceClass
 
 
 class YoutubeDLTask(Task[str]):
+    resource_class = ResourceClass.NETWORK
 
     def __init__(self, link: str, output_path: str):
         self.link = link
@@ -16,7 +18,12 @@ class YoutubeDLTask(Task[str]):
         # If downloading from reddit, use the DASH video, not the HLS video, which has corruption at 6 second intervals
         if "v.redd.it" in self.link or "reddit.com" in self.link:
             ydl_opts["format"] = "dash-VIDEO-1+dash-AUDIO-1/bestvideo+bestaudio/best"
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([self.link])
+        # youtube_dl blocks while it downloads, so is run off the event loop
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._download, ydl_opts)
         files = glob.glob(f"{self.output_path}*")
         return files[0]
+
+    def _download(self, ydl_opts: dict) -> None:
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([self.link])
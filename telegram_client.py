@@ -1,16 +1,22 @@
 import logging
+import time
 from asyncio import Future
-from typing import Callable, Coroutine, Union, Generator, Optional, TypeVar, Any, List
+from collections import OrderedDict
+from typing import Callable, Coroutine, Union, Generator, Optional, TypeVar, Any, List, Collection, Tuple, Dict
 
 import telethon
 from telethon import events, Button
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError
 from telethon.tl.custom import message
 from telethon.tl.functions.channels import EditAdminRequest
-from telethon.tl.functions.messages import MigrateChatRequest, GetScheduledHistoryRequest
-from telethon.tl.types import ChatAdminRights, ChannelParticipantsAdmins, ChannelParticipantCreator
+from telethon.tl.functions.messages import MigrateChatRequest, GetScheduledHistoryRequest, \
+    GetScheduledMessagesRequest
+from telethon.tl.types import ChatAdminRights, ChannelParticipantsAdmins, ChannelParticipantCreator, \
+    MessageMediaDocument, Document, InputDocumentFileLocation, UpdateChannelParticipant, PeerChannel
 
 from group import ChatData, ChannelData, WorkshopData
-from message import MessageData
+from media_downloader import MediaDownloader
+from message import MessageData, MediaLocator
 
 R = TypeVar("R")
 
@@ -29,7 +35,21 @@ def message_data_from_telegram(msg: telethon.tl.custom.message.Message, schedule
         (msg.file or None) and msg.file.mime_type,
         msg.reply_to_msg_id,
         sender_id,
-        scheduled
+        scheduled,
+        media_locator_from_telegram(msg)
+    )
+
+
+def media_locator_from_telegram(msg: telethon.tl.custom.message.Message) -> Optional[MediaLocator]:
+    if not isinstance(msg.media, MessageMediaDocument) or not isinstance(msg.media.document, Document):
+        return None
+    document = msg.media.document
+    return MediaLocator(
+        document.id,
+        document.access_hash,
+        document.file_reference,
+        document.size,
+        document.dc_id
     )
 
 
@@ -42,7 +62,20 @@ def sender_id_from_telegram(msg: telethon.tl.custom.message.Message) -> int:
 
 
 class TelegramClient:
-    def __init__(self, api_id: int, api_hash: str, pipeline_bot_token: str = None, public_bot_token: str = None):
+    # Maximum number of telethon message objects to hold on to, for downloading media from
+    MESSAGE_CACHE_SIZE = 1000
+    # Number of seconds to trust a cached list of chat admins for
+    ADMIN_CACHE_TTL = 300
+
+    def __init__(
+            self,
+            api_id: int,
+            api_hash: str,
+            pipeline_bot_token: str = None,
+            public_bot_token: str = None,
+            max_concurrent_downloads: int = 4,
+            on_media_locator_refreshed: Optional[Callable[[MessageData], None]] = None
+    ):
         self.client = telethon.TelegramClient('duplicate_checker', api_id, api_hash)
         self.client.start()
         self.pipeline_bot_id = None
@@ -54,26 +87,42 @@ class TelegramClient:
         if public_bot_token:
             self.public_bot_client = telethon.TelegramClient('duplicate_checker_public_bot', api_id, api_hash)
             self.public_bot_client.start(bot_token=public_bot_token)
-        self.message_cache = {}
+        self.message_cache: 'OrderedDict[Tuple[int, int, bool], telethon.tl.custom.message.Message]' = OrderedDict()
+        self.media_downloader = MediaDownloader(self._download_media, max_concurrent_downloads)
+        # Called with a message whose media locator was replaced by a fresh one, so it can be stored
+        self.on_media_locator_refreshed = on_media_locator_refreshed
+        # Cache of chat ID to the time admins were listed, and the list of admins
+        self.admin_cache: Dict[int, Tuple[float, List[telethon.tl.types.User]]] = {}
 
     async def initialise(self) -> None:
         # Get dialogs list, to ensure entities are initialised in library
         await self.client.get_dialogs()
         pipeline_bot_user = await self.pipeline_bot_client.get_me()
         self.pipeline_bot_id = pipeline_bot_user.id
+        # Drop cached admin lists when chat participants change
+        self.client.add_event_handler(self._on_chat_action, events.ChatAction())
+        self.client.add_event_handler(self._on_channel_participant_update, events.Raw(UpdateChannelParticipant))
 
-    def _save_message(self, msg: telethon.tl.custom.message.Message):
+    def _save_message(self, msg: telethon.tl.custom.message.Message, scheduled: bool = False):
         # UpdateShortMessage events do not contain a populated msg.chat, so use msg.chat_id sometimes.
-        chat_id = chat_id_from_telegram(msg)
-        message_id = msg.id
-        if chat_id not in self.message_cache:
-            self.message_cache[chat_id] = {}
-        self.message_cache[chat_id][message_id] = msg
-
-    def _get_message(self, chat_id: int, message_id: int) -> Optional[telethon.tl.custom.message.Message]:
-        if chat_id not in self.message_cache:
-            return None
-        return self.message_cache[chat_id].get(message_id)
+        # Scheduled messages have their own IDs, which can clash with sent messages' IDs
+        key = (chat_id_from_telegram(msg), msg.id, scheduled)
+        self.message_cache[key] = msg
+        self.message_cache.move_to_end(key)
+        if len(self.message_cache) > self.MESSAGE_CACHE_SIZE:
+            self.message_cache.popitem(last=False)
+
+    def _get_message(
+            self,
+            chat_id: int,
+            message_id: int,
+            scheduled: bool = False
+    ) -> Optional[telethon.tl.custom.message.Message]:
+        key = (chat_id, message_id, scheduled)
+        msg = self.message_cache.get(key)
+        if msg is not None:
+            self.message_cache.move_to_end(key)
+        return msg
 
     async def get_channel_data(self, handle: str) -> ChannelData:
         entity = await self.client.get_entity(handle)
@@ -88,9 +137,10 @@ class TelegramClient:
     async def iter_channel_messages(
             self,
             chat_data: ChatData,
-            and_scheduled: bool = True
+            and_scheduled: bool = True,
+            min_id: int = 0
     ) -> Generator[MessageData, None, None]:
-        async for msg in self.client.iter_messages(chat_data.chat_id):
+        async for msg in self.client.iter_messages(chat_data.chat_id, min_id=min_id):
             # Skip edit photo events.
             if msg.action.__class__.__name__ in ['MessageActionChatEditPhoto']:
                 continue
@@ -108,14 +158,57 @@ class TelegramClient:
             hash=0
         ))
         for msg in messages.messages:
-            self._save_message(msg)
+            self._save_message(msg, scheduled=True)
             yield message_data_from_telegram(msg, scheduled=True)
 
-    async def download_media(self, chat_id: int, message_id: int, path: str) -> Optional[str]:
-        msg = self._get_message(chat_id, message_id)
+    async def download_media(self, message_data: MessageData, path: str) -> Optional[str]:
+        return await self.media_downloader.download(message_data, path)
+
+    async def _download_media(self, message_data: MessageData, path: str) -> Optional[str]:
+        msg = self._get_message(message_data.chat_id, message_data.message_id, message_data.is_scheduled)
+        if msg is not None:
+            return await self.client.download_media(message=msg, file=path)
+        locator = message_data.media_locator
+        if locator is not None:
+            try:
+                return await self._download_media_locator(locator, path)
+            except (FileReferenceExpiredError, FileReferenceInvalidError):
+                logging.info(f"File reference expired or invalid for message {message_data}, fetching message again")
+        # Fetch the message again, for a fresh file reference
+        msg = await self._fetch_message(message_data)
+        if msg is None:
+            return None
+        self._save_message(msg, message_data.is_scheduled)
+        message_data.media_locator = media_locator_from_telegram(msg)
+        if message_data.media_locator is not None and self.on_media_locator_refreshed is not None:
+            self.on_media_locator_refreshed(message_data)
         return await self.client.download_media(message=msg, file=path)
 
-    def add_message_handler(self, function: Callable, chat_ids: List[int]) -> None:
+    async def _fetch_message(self, message_data: MessageData) -> Optional[telethon.tl.custom.message.Message]:
+        if not message_data.is_scheduled:
+            return await self.client.get_messages(message_data.chat_id, ids=message_data.message_id)
+        # get_messages only looks up sent messages, so scheduled ones need their own request
+        # noinspection PyTypeChecker
+        messages = await self.client(GetScheduledMessagesRequest(
+            peer=message_data.chat_id,
+            id=[message_data.message_id]
+        ))
+        return next(
+            (msg for msg in messages.messages if msg.id == message_data.message_id and getattr(msg, "media", None)),
+            None
+        )
+
+    async def _download_media_locator(self, locator: MediaLocator, path: str) -> str:
+        input_location = InputDocumentFileLocation(
+            id=locator.document_id,
+            access_hash=locator.access_hash,
+            file_reference=locator.file_reference,
+            thumb_size=""
+        )
+        await self.client.download_file(input_location, path, file_size=locator.file_size, dc_id=locator.dc_id)
+        return path
+
+    def add_message_handler(self, function: Callable, chat_ids: Collection[int]) -> None:
         async def function_wrapper(event: events.NewMessage.Event):
             chat_id = chat_id_from_telegram(event.message)
             if chat_id not in chat_ids:
@@ -130,7 +223,7 @@ class TelegramClient:
 
         self.client.add_event_handler(function_wrapper, events.NewMessage())
 
-    def add_edit_handler(self, function: Callable, chat_ids: List[int]) -> None:
+    def add_edit_handler(self, function: Callable, chat_ids: Collection[int]) -> None:
         async def function_wrapper(event: events.NewMessage.Event):
             chat_id = chat_id_from_telegram(event.message)
             if chat_id not in chat_ids:
@@ -231,16 +324,37 @@ class TelegramClient:
             "Helpful bot"
         ))
 
+    async def _on_chat_action(self, event: events.ChatAction.Event) -> None:
+        self.invalidate_admin_cache(event.chat_id)
+
+    async def _on_channel_participant_update(self, update: UpdateChannelParticipant) -> None:
+        self.invalidate_admin_cache(telethon.utils.get_peer_id(PeerChannel(update.channel_id)))
+
+    def invalidate_admin_cache(self, chat_id: int) -> None:
+        self.admin_cache.pop(chat_id, None)
+
+    async def _list_admins(self, chat_data: ChatData) -> List[telethon.tl.types.User]:
+        cached = self.admin_cache.get(chat_data.chat_id)
+        if cached is not None and time.monotonic() - cached[0] < self.ADMIN_CACHE_TTL:
+            return cached[1]
+        admins = [
+            admin async for admin in self.client.iter_participants(
+                chat_data.chat_id, filter=ChannelParticipantsAdmins()
+            )
+        ]
+        self.admin_cache[chat_data.chat_id] = (time.monotonic(), admins)
+        return admins
+
     async def list_authorized_channel_posters(self, chat_data: ChatData) -> List[int]:
         allowed_ids = []
-        async for admin in self.client.iter_participants(chat_data.chat_id, filter=ChannelParticipantsAdmins()):
+        for admin in await self._list_admins(chat_data):
             if isinstance(admin.participant, ChannelParticipantCreator) or admin.participant.admin_rights.post_messages:
                 allowed_ids.append(admin.id)
         return allowed_ids
 
     async def list_authorized_to_delete(self, chat_data: ChatData) -> List[int]:
         allowed_ids = []
-        async for admin in self.client.iter_participants(chat_data.chat_id, filter=ChannelParticipantsAdmins()):
+        for admin in await self._list_admins(chat_data):
             if (
                     isinstance(admin.participant, ChannelParticipantCreator)
                     or admin.participant.admin_rights.delete_messages